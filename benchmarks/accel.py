@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Pointer acceleration latency and CPU use at 1000 Hz.
+
+By default the real path is measured: a virtual source mouse is created
+through uinput, grabbed by ``AccelThread`` and the accelerated reports are
+read back from its "rogdrv accel" output device, so the latency covers
+the evdev read, the pipeline and the uinput write (plus the kernel's
+delivery to and from the thread). Requires python-evdev and write access
+to /dev/uinput; the pointer moves back and forth while it runs. The CPU
+share includes the benchmark's own writing and reading.
+
+With ``--pipeline`` only ``AccelPipeline.process`` is timed on in-memory
+buffers, no device is needed.
+
+    python3 benchmarks/accel.py [--seconds 60] [--pipeline]
+"""
+
+import argparse
+import os
+import random
+import select
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rog.accel import (  # noqa: E402
+    EV_REL, EV_SYN, EVENT, REL_X, REL_Y, SYN_REPORT,
+    AccelCurve, AccelPipeline, AccelThread)
+
+RATE = 1000
+
+CURVE = AccelCurve(sensitivity=0.8, acceleration=0.05, cap=4.0)
+
+
+def motion(rnd, i):
+    # alternating directions keep the pointer in place, never zero
+    sign = 1 if i % 2 else -1
+    return sign * rnd.randint(5, 40), -sign * rnd.randint(5, 40)
+
+
+def measure_pipeline(seconds):
+    rnd = random.Random(0)
+    reads = []
+    for i in range(RATE * seconds):
+        sec, usec = divmod(i * 1000, 1000000)
+        dx, dy = motion(rnd, i)
+        reads.append(
+            EVENT.pack(sec, usec, EV_REL, REL_X, dx) +
+            EVENT.pack(sec, usec, EV_REL, REL_Y, dy) +
+            EVENT.pack(sec, usec, EV_SYN, SYN_REPORT, 0))
+
+    pipeline = AccelPipeline(CURVE)
+    timings = []
+    clock = time.perf_counter
+    for data in reads:
+        start = clock()
+        pipeline.process(data)
+        timings.append(clock() - start)
+    return timings, 0
+
+
+def find_output(name):
+    import evdev
+
+    for path in evdev.list_devices():
+        device = evdev.InputDevice(path)
+        if device.name == name:
+            return device
+        device.close()
+
+
+def measure_device(seconds):
+    import evdev
+
+    source = evdev.UInput(
+        {EV_REL: [REL_X, REL_Y], evdev.ecodes.EV_KEY: [evdev.ecodes.BTN_LEFT]},
+        name='rogdrv accel benchmark')
+    time.sleep(0.5)  # wait for the node
+    thread = AccelThread(evdev.InputDevice(source.device.path), CURVE)
+    thread.start()
+    time.sleep(0.5)
+    output = find_output('rogdrv accel')
+    if output is None:
+        thread.stop()
+        source.close()
+        sys.exit('Output device of AccelThread not found')
+
+    rnd = random.Random(0)
+    poll = select.poll()
+    poll.register(output.fd, select.POLLIN)
+    timings = []
+    lost = 0
+    clock = time.perf_counter
+    next_report = clock()
+    try:
+        for i in range(RATE * seconds):
+            dx, dy = motion(rnd, i)
+            start = clock()
+            source.write(EV_REL, REL_X, dx)
+            source.write(EV_REL, REL_Y, dy)
+            source.syn()
+
+            # wait for the end of the accelerated report
+            done = False
+            while not done:
+                if not poll.poll(100):
+                    lost += 1
+                    break
+                data = os.read(output.fd, EVENT.size * 64)
+                done = any(
+                    type == EV_SYN and code == SYN_REPORT
+                    for _, _, type, code, _ in EVENT.iter_unpack(data))
+            if done:
+                timings.append(clock() - start)
+
+            next_report += 1 / RATE
+            delay = next_report - clock()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        thread.stop()
+        output.close()
+        source.close()
+    return timings, lost
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s', '--seconds', type=int, default=60,
+        help='Seconds of input')
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='Time only the pipeline on in-memory buffers, without uinput')
+    args = parser.parse_args()
+
+    cpu_start = time.process_time()
+    if args.pipeline:
+        timings, lost = measure_pipeline(args.seconds)
+    else:
+        timings, lost = measure_device(args.seconds)
+    cpu = time.process_time() - cpu_start
+    if not timings:
+        sys.exit('No reports came through')
+
+    timings.sort()
+    print('Reports:      {} ({} lost)'.format(len(timings), lost))
+    print('Mean latency: {:.2f} us'.format(sum(timings) / len(timings) * 1e6))
+    print('p99 latency:  {:.2f} us'.format(timings[int(len(timings) * 0.99)] * 1e6))
+    print('Max latency:  {:.2f} us'.format(timings[-1] * 1e6))
+    print('CPU at {} Hz: {:.3f} %'.format(RATE, cpu / args.seconds * 100))
+
+
+if __name__ == '__main__':
+    main()
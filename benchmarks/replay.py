@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Enumeration against a recorded capture, for regression and performance
+checks without the hardware:
+
+    rogdrv-config dpi --record gladius.rgdr        # on a machine with the mouse
+    python3 benchmarks/replay.py gladius.rgdr      # anywhere
+
+Exits with an error if the driver didn't send the recorded traffic.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rog import api  # noqa: E402
+from rog.record import HidReplay  # noqa: E402
+
+
+async def replay(replay):
+    start = time.perf_counter()
+    sessions = await api.discover(timeout=0)
+    enumeration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    states = [await api.get_state(session) for session in sessions]
+    read = time.perf_counter() - start
+    return enumeration, read, states
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture', type=str, help='Capture file')
+    parser.add_argument(
+        '--realtime', action='store_true',
+        help='Keep the recorded timing')
+    args = parser.parse_args()
+
+    capture = HidReplay(args.capture, realtime=args.realtime)
+    for device in capture.devices:
+        print('Device: {} ({:04x}:{:04x}, bus {})'.format(
+            device.name, device.vid, device.pid, device.bus))
+    api.set_capture(replay=capture)
+    enumeration, read, states = asyncio.run(replay(capture))
+
+    for state in states:
+        print(state)
+    print('Enumeration: {:.3f} s'.format(enumeration))
+    print('State read:  {:.3f} s'.format(read))
+    print('Mismatches:  {}'.format(capture.mismatches))
+
+    if capture.mismatches or not capture.finished:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Resident memory of the tray menu.
+
+Reports RSS right after the tray is set up and after simulated menu use:
+every top level submenu is opened and closed once per cycle (closed items
+are released from the main loop, which runs after every cycle), the default
+720 cycles correspond to an hour with a submenu opened every 5 seconds.
+No device is needed, but GTK needs a display (use xvfb-run on a server).
+
+    python3 benchmarks/tray_rss.py [--cycles 720]
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+SUBMENUS = (
+    'menu_profile', 'menu_dpi', 'menu_led', 'menu_rate',
+    'menu_perf', 'menu_sleep', 'menu_battery')
+
+
+def get_rss():
+    """
+    Resident set size of the current process in KiB.
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--cycles', type=int, default=720,
+        help='Number of times every submenu is opened and closed')
+    args = parser.parse_args()
+
+    rss_python = get_rss()
+
+    from rog.ui import Gtk
+    from rog.ui.handler import TrayMenuEventHandler
+    from rog.ui.utils import get_ui_path
+
+    builder = Gtk.Builder()
+    builder.add_objects_from_file(get_ui_path(), ['menu'])
+    handler = TrayMenuEventHandler(builder)
+    builder.connect_signals(handler)
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+    rss_startup = get_rss()
+
+    for _ in range(args.cycles):
+        for name in SUBMENUS:
+            handler.on_submenu_open(builder.get_object(name))
+            handler.on_submenu_close(builder.get_object('{}_submenu'.format(name)))
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+
+    rss_used = get_rss()
+
+    print('Python interpreter: {:8d} KiB'.format(rss_python))
+    print('After startup:      {:8d} KiB'.format(rss_startup))
+    print('After {:5d} cycles: {:8d} KiB'.format(args.cycles, rss_used))
+    print('Growth:             {:8d} KiB'.format(rss_used - rss_startup))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,10 +15,12 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 import argparse
+import asyncio
 import logging
+import shlex
 import sys
-
-from gi.repository import GLib
+import threading
+import time
 
 try:
     import ratbag
@@ -26,6 +28,8 @@ except ImportError:
     sys.path.append('ratbag-python')
     import ratbag
 
+from . import api
+
 
 logger = logging.getLogger('rogdrv')
 
@@ -35,41 +39,99 @@ class ROGDRVConfig(object):
     Mouse configuration tool
     """
     def _get_device(self, callback):
-        mainloop = GLib.MainLoop()
-        ratbagd = ratbag.Ratbag.create()
+        async def main():
+            for session in await api.discover():
+                await session.run(callback, session)
 
-        ratbagd.connect('device-added', callback)
-        ratbagd.start()
+        asyncio.run(main())
 
-        GLib.timeout_add(1000, mainloop.quit)
-        mainloop.run()
+    def __init__(self):
+        self._prog = sys.argv[0]
 
-    def run(self):
+    def _main(self):
         if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
             self._help()
             return
 
-        cmd = sys.argv.pop(1)
-
         # if cmd != 'actions':
         #     self._device = get_device()
         #     if not self._device:
         #         print('Device not found')
         #         return
 
-        if not cmd.startswith('_'):
-            if hasattr(self, cmd):
-                sys.argv[0] += ' ' + cmd
-                method = getattr(self, cmd)
-                method()
-                return
+        if not self._execute(sys.argv[1:]):
+            self._help()
 
-        self._help()
+    def _execute(self, argv):
+        """
+        Run a command with its arguments, returns False if there's no such command.
+        """
+        cmd = argv[0]
+        if cmd.startswith('_') or not hasattr(self, cmd):
+            return False
+
+        sys.argv = ['{} {}'.format(self._prog, cmd)] + argv[1:]
+        getattr(self, cmd)()
+        return True
+
+    def _execute_line(self, line):
+        """
+        Run a command line inside a session and print the time it took,
+        returns whether it succeeded.
+        """
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as e:
+            print(f'Error: {e}')
+            return False
+        if not argv:
+            return True
+
+        if argv[0] in ('help', '-h', '--help'):
+            self._help()
+            return True
+        if argv[0] in ('shell', 'run'):
+            print(f'Error: {argv[0]} is not available inside a session')
+            return False
+
+        ok = True
+        start = time.perf_counter()
+        try:
+            if not self._execute(argv):
+                print(f'Unknown command: {argv[0]}')
+                return False
+        except SystemExit as e:  # argparse errors and --help
+            ok = not e.code
+        except KeyboardInterrupt:
+            print()
+            ok = False
+        except Exception as e:
+            logger.debug('command failed', exc_info=True)
+            print(f'Error: {e}')
+            ok = False
+        print('[{:.1f} ms]'.format((time.perf_counter() - start) * 1000))
+        return ok
+
+    def _open_session(self):
+        """
+        Open the devices for the following commands.
+        """
+        start = time.perf_counter()
+        sessions = asyncio.run(api.discover())
+        print('{} [{:.1f} ms]'.format(
+            ', '.join(session.name for session in sessions) or 'No devices found',
+            (time.perf_counter() - start) * 1000))
 
     def _help(self):
         print('''Usage:
   rogdrv-config <command> --help - display help for a command
-  rogdrv-config <command> [--debug] [args] - run a command
+  rogdrv-config <command> [--debug] [device options] [args] - run a command
+
+Device options:
+  --device vid:pid - only use devices with these IDs
+  --hidraw /dev/hidrawN - only use these hidraw nodes
+  --record FILE - record the HID traffic to a capture file
+  --replay FILE [--replay-realtime] - use a capture file instead of the device
 
 Available commands:''')
 
@@ -77,9 +139,6 @@ Available commands:''')
             if cmd.startswith('_'):
                 continue
 
-            if cmd == 'run':
-                continue
-
             method = getattr(self, cmd)
             doc = (
                 method.__doc__
@@ -140,15 +199,13 @@ Available commands:''')
             help='Profile no. to set, starting from 0')
         args = parser.parse_args()
 
-        def read(r, device):
+        def read(session):
             if args.profile >= 0:
-                for profile in device.profiles:
-                    if profile.index == args.profile:
-                        profile.set_active()
+                session.set_profile(args.profile)
 
-            for profile in device.profiles:
-                if profile.active:
-                    print('Profile: {}'.format(profile.index))
+            profile = session.active_profile
+            if profile is not None:
+                print('Profile: {}'.format(profile.index))
 
         self._get_device(read)
 
@@ -164,7 +221,7 @@ Available commands:''')
             '-a', '--action', type=str, required=False, help='Action code')
         args = parser.parse_args()
 
-        def read(r, device):
+        def read(session):
             from ratbag.drivers.asus import asus_get_linux_key_code
 
             if args.button >= 0 and args.action:
@@ -174,31 +231,23 @@ Available commands:''')
                 else:
                     action_code = int(action)
 
-                for profile in device.profiles:
-                    if not profile.active:
-                        continue
-
-                    for button in profile.buttons:
-                        if button.index == args.button:
-                            if action_code >= ratbag.ActionSpecial.Special.UNKNOWN.value:
-                                for name in dir(ratbag.ActionSpecial.Special):
-                                    special = getattr(ratbag.ActionSpecial.Special, name)
-                                    if hasattr(special, 'value') and special.value == action_code:
-                                        button.set_action(ratbag.ActionSpecial.create(special))
-                            elif action_code >= 0xF0:
-                                button.set_action(ratbag.ActionButton.create(action_code - 0xF0 + 1))
-                            else:
-
-                                button.set_action(ratbag.ActionKey.create(asus_get_linux_key_code(action_code)))
-
-                device.emit('commit', None)
+                if action_code >= ratbag.ActionSpecial.Special.UNKNOWN.value:
+                    for name in dir(ratbag.ActionSpecial.Special):
+                        special = getattr(ratbag.ActionSpecial.Special, name)
+                        if hasattr(special, 'value') and special.value == action_code:
+                            session.set_button(
+                                args.button, ratbag.ActionSpecial.create(special))
+                elif action_code >= 0xF0:
+                    session.set_button(
+                        args.button, ratbag.ActionButton.create(action_code - 0xF0 + 1))
+                else:
+                    session.set_button(
+                        args.button, ratbag.ActionKey.create(asus_get_linux_key_code(action_code)))
 
-            for profile in device.profiles:
-                if not profile.active:
-                    continue
+                session.commit()
 
-                for button in profile.buttons:
-                    print(f'{button.index}: {button.action}')
+            for button in session.active_profile.buttons:
+                print(f'{button.index}: {button.action}')
 
         self._get_device(read)
 
@@ -221,7 +270,7 @@ Available commands:''')
             help='LED mode: ON (default), CYCLE, BREATHING')
         args = parser.parse_args()
 
-        def read(r, device):
+        def read(session):
             if args.led >= 0 and args.color:
                 # convert color from HTML
                 r = 0
@@ -233,27 +282,17 @@ Available commands:''')
                     g = int(color[2:4], 16)
                     b = int(color[4:6], 16)
 
-                for profile in device.profiles:
-                    if not profile.active:
-                        continue
+                session.set_leds(
+                    mode=getattr(ratbag.Led.Mode, args.mode),
+                    color=(r, g, b),
+                    brightness=max(args.brightness, 0),
+                    index=args.led)
+                session.commit()
 
-                    for led in profile.leds:
-                        if led.index == args.led:
-                            mode = getattr(ratbag.Led.Mode, args.mode)
-                            led.set_mode(mode)
-                            led.set_color((r, g, b))
-                            led.set_brightness(max(args.brightness, 0))
-
-                device.emit('commit', None)
-
-            for profile in device.profiles:
-                if not profile.active:
-                    continue
-
-                for led in profile.leds:
-                    # convert color to HTML
-                    color = '#{:02x}{:02x}{:02x}'.format(*led.color)
-                    print(f'{led.index}: {led.mode.name} {color} brightness={led.brightness}')
+            for led in session.active_profile.leds:
+                # convert color to HTML
+                color = '#{:02x}{:02x}{:02x}'.format(*led.color)
+                print(f'{led.index}: {led.mode.name} {color} brightness={led.brightness}')
 
         self._get_device(read)
 
@@ -268,26 +307,50 @@ Available commands:''')
         parser.add_argument(
             '-p', '--preset', type=int, default=0, required=False,
             help='Preset no. to set, starting from 0')
+        switch = parser.add_mutually_exclusive_group()
+        switch.add_argument(
+            '--up', dest='switch', action='store_const', const='up',
+            help='Select the next DPI preset')
+        switch.add_argument(
+            '--down', dest='switch', action='store_const', const='down',
+            help='Select the previous DPI preset')
+        switch.add_argument(
+            '--cycle', dest='switch', action='store_const', const='cycle',
+            help='Select the next DPI preset, wrapping around')
+        switch.add_argument(
+            '-s', '--select', dest='switch', type=str, metavar='PRESET',
+            help='Select a DPI preset')
         args = parser.parse_args()
 
-        def read(r, device):
-            if args.dpi >= 0:
-                for profile in device.profiles:
-                    if not profile.active:
-                        continue
-
-                    for resolution in profile.resolutions:
-                        if resolution.index == args.preset:
-                            resolution.set_dpi((args.dpi, args.dpi))
-
-                device.emit('commit', None)
+        if args.switch is not None and args.dpi < 0:
+            # the running rogdrv switches from its preset table right away
+            from .control import send_command
 
-            for profile in device.profiles:
-                if not profile.active:
-                    continue
+            reply = send_command('dpi {}'.format(args.switch))
+            if reply is not None:
+                status, _, result = reply.partition(' ')
+                if status == 'ok':
+                    preset, dpi = result.split()
+                    print(f'DPI Preset {preset}: {dpi} (active)')
+                else:
+                    print(f'Error: {result}')
+                return
 
-                for resolution in profile.resolutions:
-                    print(f'DPI Preset {resolution.index}: {resolution.dpi[0]}')
+        def read(session):
+            if args.dpi >= 0:
+                session.set_dpi(args.dpi, args.preset)
+                session.commit()
+            elif args.switch is not None:
+                try:
+                    session.select_dpi_preset(session.find_dpi_preset(args.switch))
+                except ValueError as e:
+                    print(f'Error: {e}')
+                    return
+                session.commit()
+
+            active = session.dpi_preset
+            for index, dpi in enumerate(session.dpi_presets):
+                print(f'DPI Preset {index}: {dpi}' + (' (active)' if index == active else ''))
 
         self._get_device(read)
 
@@ -301,21 +364,12 @@ Available commands:''')
             help='Polling rate in Hz: 125, 250, 500, 1000')
         args = parser.parse_args()
 
-        def read(r, device):
+        def read(session):
             if args.rate >= 0:
-                for profile in device.profiles:
-                    if not profile.active:
-                        continue
-
-                    profile.set_report_rate(args.rate)
-
-                device.emit('commit', None)
+                session.set_report_rate(args.rate)
+                session.commit()
 
-            for profile in device.profiles:
-                if not profile.active:
-                    continue
-
-                print(f'Polling rate: {profile.report_rate} Hz')
+            print(f'Polling rate: {session.active_profile.report_rate} Hz')
 
         self._get_device(read)
 
@@ -364,22 +418,13 @@ Available commands:''')
             help='Angle snapping: 0 - disabled, 1 - enabled')
         args = parser.parse_args()
 
-        def read(r, device):
+        def read(session):
             if args.snapping >= 0:
-                for profile in device.profiles:
-                    if not profile.active:
-                        continue
-
-                    profile.set_angle_snapping(args.snapping)
-
-                device.emit('commit', None)
+                session.set_angle_snapping(args.snapping)
+                session.commit()
 
-            for profile in device.profiles:
-                if not profile.active:
-                    continue
-
-                print('Angle snapping: {}'.format(
-                    'enabled' if profile.angle_snapping else 'disabled'))
+            print('Angle snapping: {}'.format(
+                'enabled' if session.active_profile.angle_snapping else 'disabled'))
 
         self._get_device(read)
 
@@ -393,24 +438,197 @@ Available commands:''')
             help='Response in ms: 4, 8, 12, 16, 20, 24, 28, 32')
         args = parser.parse_args()
 
-        def read(r, device):
+        def read(session):
             if args.response > 0:
-                for profile in device.profiles:
-                    if not profile.active:
-                        continue
+                session.set_debounce(args.response)
+                session.commit()
+
+            print(f'Debounce time: {session.active_profile.debounce} ms')
 
-                    profile.set_debounce(args.response)
+        self._get_device(read)
+
+    def library(self):
+        """
+        save/activate host-side profiles
+        """
+        from .library import ProfileLibrary, profile_to_dict
+
+        parser = argparse.ArgumentParser()
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(
+            '-s', '--save', type=str, required=False, metavar='NAME',
+            help='Save the active profile to the library')
+        group.add_argument(
+            '-a', '--activate', type=str, required=False, metavar='NAME',
+            help='Activate a library profile, '
+                 'it replaces the least recently used slot if not on the device')
+        group.add_argument(
+            '-d', '--delete', type=str, required=False, metavar='NAME',
+            help='Delete a profile from the library')
+        args = parser.parse_args()
 
-                device.emit('commit', None)
+        library = ProfileLibrary()
 
-            for profile in device.profiles:
-                if not profile.active:
-                    continue
+        if args.delete:
+            try:
+                library.delete(args.delete)
+            except KeyError:
+                print('Profile not found: {}'.format(args.delete))
+                return
+            except ValueError as e:
+                print(e)
+                return
 
-                print(f'Debounce time: {profile.debounce} ms')
+        def read(session):
+            if args.save:
+                try:
+                    library.save(args.save, profile_to_dict(session.active_profile))
+                except ValueError as e:
+                    print(e)
+                    return
+
+            if args.activate:
+                try:
+                    slot = library.activate(session, args.activate)
+                except KeyError:
+                    print('Profile not found: {}'.format(args.activate))
+                    return
+                except ValueError as e:
+                    print(e)
+                    return
+                print('Profile {} is active in slot {}'.format(args.activate, slot))
+
+            slots = library.slots(session)
+            for index, name in sorted(slots.items()):
+                print('Slot {}: {}'.format(index, name or '-'))
+            print('Library: {}'.format(', '.join(library.names()) or '-'))
 
         self._get_device(read)
 
+    def stats(self):
+        """
+        export usage statistics collected by rogdrv --analytics
+        """
+        import glob
+        import os
+
+        from .analytics import export
+        from .utils import get_data_dir
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '-f', '--format', type=str, required=False, default='json',
+            choices=('json', 'csv'), help='Output format')
+        args = parser.parse_args()
+
+        paths = sorted(glob.glob(os.path.join(get_data_dir(), 'usage-*.bin')))
+        if not paths:
+            print('No statistics collected')
+            return
+
+        export(paths, args.format, sys.stdout)
+
+    def watch(self):
+        """
+        print device changes until interrupted
+        """
+        from .watch import POLLERS, DeviceWatcher, print_json, print_text
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '-j', '--json', action='store_true',
+            help='Print one JSON object per line')
+        parser.add_argument(
+            '-i', '--interval', type=str, action='append', default=[],
+            metavar='NAME=SECONDS',
+            help='Poll interval of a value, 0 disables polling. '
+                 'Values: {}'.format(', '.join(
+                     '{} (default {} s)'.format(name, interval)
+                     for name, (_, interval) in POLLERS.items())))
+        args = parser.parse_args()
+
+        intervals = {}
+        for interval in args.interval:
+            name, sep, seconds = interval.partition('=')
+            if name not in POLLERS:
+                parser.error('unknown value: {}'.format(name))
+            try:
+                if not sep:
+                    raise ValueError
+                intervals[name] = float(seconds)
+            except ValueError:
+                parser.error('invalid interval: {}, NAME=SECONDS expected'.format(interval))
+
+        watcher = DeviceWatcher(
+            print_json if args.json else print_text, intervals)
+        bridge = api.get_bridge()
+        bridge.connect(watcher.add_session)
+
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            bridge.call(watcher.stop).result()
+
+    def shell(self):
+        """
+        run commands interactively in one device session
+        """
+        parser = argparse.ArgumentParser(
+            description='Accepts the rogdrv-config commands with their arguments, '
+                        'the devices are opened once for the whole session. '
+                        'Type "help" for the commands, "exit" to quit.')
+        parser.parse_args()
+
+        try:
+            import readline  # noqa: F401, line editing and history for input()
+        except ImportError:
+            pass
+
+        self._open_session()
+        while True:
+            try:
+                line = input('rogdrv> ')
+            except EOFError:
+                print()
+                break
+            except KeyboardInterrupt:
+                print()
+                continue
+
+            if line.strip() in ('exit', 'quit'):
+                break
+            self._execute_line(line)
+
+    def run(self):
+        """
+        run commands from a file in one device session
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            'script', type=str,
+            help='File with one command per line (# starts a comment), - for stdin')
+        parser.add_argument(
+            '-k', '--keep-going', action='store_true',
+            help='Continue after a failed command')
+        args = parser.parse_args()
+
+        if args.script == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(args.script) as f:
+                lines = f.readlines()
+
+        self._open_session()
+        for number, line in enumerate(lines, 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+
+            print('> {}'.format(line.strip()))
+            if not self._execute_line(line) and not args.keep_going:
+                sys.exit('{}:{}: command failed'.format(args.script, number))
+
 
 def logging_init():
     if '--debug' in sys.argv:
@@ -421,13 +639,84 @@ def logging_init():
         logger.setLevel(logging.DEBUG)
 
 
+def add_device_arguments(parser):
+    parser.add_argument(
+        '--device', type=str, action='append', default=[], metavar='VID:PID',
+        help='Only use devices with these IDs (hex), the supported devices by default')
+    parser.add_argument(
+        '--hidraw', type=str, action='append', default=[], metavar='/dev/hidrawN',
+        help='Only use these hidraw nodes')
+    capture = parser.add_mutually_exclusive_group()
+    capture.add_argument(
+        '--record', type=str, default=None, metavar='FILE',
+        help='Record the HID traffic to a capture file')
+    capture.add_argument(
+        '--replay', type=str, default=None, metavar='FILE',
+        help='Use a capture file instead of the real device')
+    parser.add_argument(
+        '--replay-realtime', action='store_true',
+        help='Replay with the recorded timing instead of as fast as possible')
+
+
+def device_init(parser, args):
+    if args.device or args.hidraw:
+        from .devices import DeviceFilter
+        from .utils import load_config
+        try:
+            api.set_device_filter(DeviceFilter.from_config(
+                load_config(), args.device, args.hidraw))
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.record:
+        from .record import HidRecorder
+        api.set_capture(recorder=HidRecorder(args.record))
+
+    if args.replay:
+        from .record import HidReplay
+        try:
+            api.set_capture(replay=HidReplay(args.replay, args.replay_realtime))
+        except (OSError, ValueError) as e:
+            parser.error('unable to read {}: {}'.format(args.replay, e))
+
+
 def rogdrv():
     logging_init()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--metrics-textfile', type=str, default=None, metavar='PATH',
+        help='Write Prometheus metrics to a node_exporter textfile collector file')
+    parser.add_argument(
+        '--metrics-port', type=int, default=None, metavar='PORT',
+        help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument(
+        '--accel', action='store_true',
+        help='Apply the pointer acceleration curve from the [accel] section '
+             'of the configuration (requires python-evdev)')
+    parser.add_argument(
+        '--powersave', action='store_true',
+        help='Lower the report rate of a wireless mouse while idle or low on battery, '
+             'see the [powersave] section of the configuration')
+    parser.add_argument(
+        '--analytics', action='store_true',
+        help='Collect usage statistics (clicks, scrolling, travel, time per DPI '
+             'preset and profile), see rogdrv-config stats')
+    add_device_arguments(parser)
+    args = parser.parse_args()
+    device_init(parser, args)
+
     from .ui import gtk3_main
-    gtk3_main()
+    gtk3_main(args)
 
 
 def rogdrv_config():
     logging_init()
+
+    # device options are accepted by every command
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    add_device_arguments(parser)
+    args, sys.argv[1:] = parser.parse_known_args()
+    device_init(parser, args)
     app = ROGDRVConfig()
-    app.run()
+    app._main()
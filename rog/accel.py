@@ -0,0 +1,249 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Software pointer acceleration.
+
+The evdev node of the mouse is grabbed, relative motion is scaled by
+a precomputed gain table and re-emitted through uinput. Events are read
+and written as raw ``struct input_event`` batches, one read and one write
+per wake-up, and the fractional part of the scaled motion is carried over
+to the next report.
+
+Requires python-evdev for grabbing the device and creating the uinput one.
+"""
+
+import glob
+import os
+import select
+import struct
+import threading
+
+from . import logger
+
+# linux/input-event-codes.h
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_REL = 0x02
+SYN_REPORT = 0
+REL_X = 0x00
+REL_Y = 0x01
+
+# struct input_event: timeval, type, code, value
+EVENT = struct.Struct('llHHi')
+
+# max. events read at once
+BATCH_SIZE = 64
+
+# gain table size, faster motion uses the last entry
+TABLE_SIZE = 256
+
+
+class AccelCurve(object):
+    """
+    Gain as a function of speed (counts per report):
+
+        gain = sensitivity * (1 + (acceleration * max(speed - offset, 0)) ** (exponent - 1))
+
+    limited to ``cap`` (if set), precomputed for integer speeds.
+    """
+    def __init__(self, sensitivity=1.0, acceleration=0.0, offset=0.0, exponent=2.0, cap=0.0):
+        self.table = []
+        for speed in range(TABLE_SIZE):
+            gain = 1.0
+            if acceleration > 0:
+                gain += (acceleration * max(speed - offset, 0)) ** (exponent - 1)
+            gain *= sensitivity
+            if cap > 0:
+                gain = min(gain, cap)
+            self.table.append(gain)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Curve from the [accel] section of the configuration.
+        """
+        return cls(**{
+            name: config.getfloat('accel', name)
+            for name in ('sensitivity', 'acceleration', 'offset', 'exponent', 'cap')
+            if config.has_option('accel', name)})
+
+    def gain(self, speed):
+        return self.table[min(int(speed), TABLE_SIZE - 1)]
+
+
+class AccelPipeline(object):
+    """
+    Applies a curve to batches of raw input events.
+    """
+    def __init__(self, curve):
+        self._table = curve.table
+        self._dx = 0
+        self._dy = 0
+        self._rx = 0.0  # sub-pixel remainders
+        self._ry = 0.0
+        self._pending = []  # other events of the current report
+
+    def process(self, data):
+        """
+        Scale the motion in ``data`` (raw events), returns raw events to emit.
+        """
+        out = []
+        table = self._table
+        last = TABLE_SIZE - 1
+
+        for sec, usec, type, code, value in EVENT.iter_unpack(data):
+            if type == EV_REL and code == REL_X:
+                self._dx += value
+            elif type == EV_REL and code == REL_Y:
+                self._dy += value
+            elif type == EV_SYN and code == SYN_REPORT:
+                dx = self._dx
+                dy = self._dy
+                if dx or dy:
+                    speed = int((dx * dx + dy * dy) ** 0.5)
+                    gain = table[speed if speed < last else last]
+
+                    rx = self._rx + dx * gain
+                    ry = self._ry + dy * gain
+                    x = int(rx)
+                    y = int(ry)
+                    self._rx = rx - x
+                    self._ry = ry - y
+                    self._dx = self._dy = 0
+
+                    if x:
+                        out.append(EVENT.pack(sec, usec, EV_REL, REL_X, x))
+                    if y:
+                        out.append(EVENT.pack(sec, usec, EV_REL, REL_Y, y))
+
+                if self._pending:
+                    out.extend(self._pending)
+                    self._pending = []
+                out.append(EVENT.pack(sec, usec, type, code, value))
+            else:
+                self._pending.append(EVENT.pack(sec, usec, type, code, value))
+
+        return b''.join(out)
+
+
+def find_event_node(nodes):
+    """
+    evdev device with relative motion among the siblings of the hidraw
+    ``nodes`` (the interfaces of one mouse) in sysfs, None if there's
+    no such device or python-evdev is missing.
+    """
+    try:
+        import evdev
+    except ImportError:
+        logger.warning('python-evdev not found, input events are not available')
+        return None
+
+    for node in nodes:
+        pattern = os.path.join(
+            '/sys/class/hidraw', os.path.basename(node), 'device', 'input', 'input*', 'event*')
+        for path in sorted(glob.glob(pattern)):
+            try:
+                device = evdev.InputDevice(os.path.join('/dev/input', os.path.basename(path)))
+            except OSError as e:
+                logger.debug('unable to open {}: {}'.format(path, e))
+                continue
+            if REL_X in device.capabilities().get(EV_REL, []):
+                return device
+            device.close()
+
+
+class EventReader(threading.Thread):
+    """
+    Reads an evdev node without grabbing it and passes every batch
+    of raw events to the ``taps``.
+    """
+    def __init__(self, device, taps=None):
+        super().__init__(name='events', daemon=True)
+        self._device = device
+        self.taps = list(taps or [])
+
+    def run(self):
+        poll = select.poll()
+        poll.register(self._device.fd, select.POLLIN)
+        try:
+            while True:
+                poll.poll()
+                try:
+                    data = os.read(self._device.fd, EVENT.size * BATCH_SIZE)
+                except BlockingIOError:
+                    continue
+
+                for tap in self.taps:
+                    tap(data)
+        except OSError as e:  # device unplugged
+            logger.debug('event reader stopped: {}'.format(e))
+
+
+class AccelThread(threading.Thread):
+    """
+    Runs the pipeline on the grabbed device until ``stop()``.
+
+    The grabbed events are not visible to other readers, so the raw
+    input batches are passed to the ``taps`` as well.
+    """
+    def __init__(self, device, curve, taps=None):
+        super().__init__(name='accel', daemon=True)
+        self._device = device
+        self._stop_r, self._stop_w = os.pipe()
+        self.pipeline = AccelPipeline(curve)
+        self.taps = list(taps or [])
+
+    def stop(self):
+        os.write(self._stop_w, b'\0')
+        self.join()
+
+    def run(self):
+        import evdev
+
+        uinput = evdev.UInput.from_device(self._device, name='rogdrv accel')
+        pipeline = self.pipeline
+        poll = select.poll()
+        poll.register(self._device.fd, select.POLLIN)
+        poll.register(self._stop_r, select.POLLIN)
+
+        logger.debug('accelerating {}'.format(self._device.path))
+        self._device.grab()
+        try:
+            while True:
+                fds = [fd for fd, _ in poll.poll()]
+                if self._stop_r in fds:
+                    break
+
+                try:
+                    data = os.read(self._device.fd, EVENT.size * BATCH_SIZE)
+                except BlockingIOError:
+                    continue
+
+                out = pipeline.process(data)
+                if out:
+                    os.write(uinput.fd, out)
+
+                for tap in self.taps:
+                    tap(data)
+        except OSError as e:  # device unplugged
+            logger.debug('acceleration stopped: {}'.format(e))
+        finally:
+            try:
+                self._device.ungrab()
+            except OSError:
+                pass
+            uinput.close()
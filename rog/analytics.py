@@ -0,0 +1,256 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Usage statistics.
+
+Input events are read in batches and added into fixed-size numeric
+arrays, so the memory use doesn't depend on how long the collector runs.
+The arrays are periodically written to a fixed-size snapshot file per
+device and can be exported as JSON or CSV.
+"""
+
+import array
+import csv
+import json
+import os
+import re
+import struct
+import time
+
+from gi.repository import GLib
+
+from . import logger
+from .accel import EV_REL, EV_SYN, EVENT, REL_X, REL_Y, SYN_REPORT
+from .utils import get_data_dir
+
+EV_KEY = 0x01
+BTN_MOUSE = 0x110
+REL_HWHEEL = 0x06
+REL_WHEEL = 0x08
+
+BUTTONS = 16  # BTN_MOUSE .. BTN_MOUSE + 15
+PRESETS = 8
+PROFILES = 8
+
+MAGIC = b'RGDU'
+VERSION = 1
+HEADER = struct.Struct('<4sBd')  # magic, version, collection start time
+
+# seconds between two snapshots
+SNAPSHOT_INTERVAL = 300
+
+BUTTON_NAMES = (
+    'left', 'right', 'middle', 'side', 'extra', 'forward', 'back', 'task')
+
+
+class UsageStats(object):
+    """
+    Aggregated usage of a device.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.clicks = array.array('Q', [0] * BUTTONS)
+        self.scroll = array.array('Q', [0] * 2)  # vertical, horizontal detents
+        self.travel = array.array('d', [0.0] * 2)  # counts, metres
+        self.dpi_time = array.array('d', [0.0] * PRESETS)  # seconds
+        self.profile_time = array.array('d', [0.0] * PROFILES)  # seconds
+
+    def _arrays(self):
+        return (self.clicks, self.scroll, self.travel, self.dpi_time, self.profile_time)
+
+    def dump(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.started))
+            for values in self._arrays():
+                values.tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls()
+        with open(path, 'rb') as f:
+            magic, version, stats.started = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{} is not a rogdrv usage snapshot'.format(path))
+            for values in stats._arrays():
+                count = len(values)
+                del values[:]
+                values.fromfile(f, count)
+        return stats
+
+    def to_dict(self):
+        clicks = {}
+        for i, count in enumerate(self.clicks):
+            if count:
+                name = BUTTON_NAMES[i] if i < len(BUTTON_NAMES) else str(i)
+                clicks[name] = count
+        return {
+            'since': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'clicks': clicks,
+            'scroll_vertical': self.scroll[0],
+            'scroll_horizontal': self.scroll[1],
+            'travel_counts': int(self.travel[0]),
+            'travel_metres': round(self.travel[1], 2),
+            'dpi_preset_seconds': {
+                str(i): round(t) for i, t in enumerate(self.dpi_time) if t},
+            'profile_seconds': {
+                str(i): round(t) for i, t in enumerate(self.profile_time) if t},
+        }
+
+    def rows(self):
+        """
+        (metric, key, value) rows for CSV export.
+        """
+        data = self.to_dict()
+        for name, value in data.items():
+            if isinstance(value, dict):
+                for key, v in value.items():
+                    yield name, key, v
+            else:
+                yield name, '', value
+
+
+def get_snapshot_path(name):
+    return os.path.join(
+        get_data_dir(), 'usage-{}.bin'.format(re.sub(r'[^\w.-]+', '_', name)))
+
+
+class UsageCollector(object):
+    """
+    Event tap collecting the usage of a session's device.
+
+    ``feed()`` is called from the input thread with raw event batches,
+    ``tick()`` runs on the GLib main loop and accounts the time spent
+    at the active profile and DPI preset.
+    """
+    def __init__(self, session, interval=1):
+        self._session = session
+        self._interval = interval
+        self._path = get_snapshot_path(session.name)
+        try:
+            self.stats = UsageStats.load(self._path)
+        except (OSError, ValueError, EOFError):
+            self.stats = UsageStats()
+
+        self._dx = 0
+        self._dy = 0
+        self._dpi = 0
+        self._profile = None
+        self._preset = None
+        self._last_tick = time.monotonic()
+        self._last_snapshot = self._last_tick
+        self._stopped = False
+
+    def start(self):
+        self.tick()
+        GLib.timeout_add_seconds(self._interval, self.tick)
+
+    def stop(self):
+        """
+        Write the last snapshot, e.g. when the device is unplugged.
+        A collector of the re-plugged device continues from it.
+        """
+        self.snapshot()
+        self._stopped = True
+
+    def feed(self, data):
+        stats = self.stats
+        clicks = stats.clicks
+        dx = self._dx
+        dy = self._dy
+
+        for _, _, type, code, value in EVENT.iter_unpack(data):
+            if type == EV_REL:
+                if code == REL_X:
+                    dx += value
+                elif code == REL_Y:
+                    dy += value
+                elif code == REL_WHEEL:
+                    stats.scroll[0] += abs(value)
+                elif code == REL_HWHEEL:
+                    stats.scroll[1] += abs(value)
+            elif type == EV_KEY:
+                if value == 1 and 0 <= code - BTN_MOUSE < BUTTONS:
+                    clicks[code - BTN_MOUSE] += 1
+            elif type == EV_SYN and code == SYN_REPORT and (dx or dy):
+                distance = (dx * dx + dy * dy) ** 0.5
+                stats.travel[0] += distance
+                if self._dpi:
+                    stats.travel[1] += distance / self._dpi * 0.0254
+                dx = dy = 0
+
+        self._dx = dx
+        self._dy = dy
+
+    def tick(self):
+        if self._stopped:
+            return False  # remove the timeout
+
+        now = time.monotonic()
+        elapsed = now - self._last_tick
+        self._last_tick = now
+
+        if self._profile is not None and self._profile < PROFILES:
+            self.stats.profile_time[self._profile] += elapsed
+        if self._preset is not None and self._preset < PRESETS:
+            self.stats.dpi_time[self._preset] += elapsed
+
+        profile = self._session.active_profile
+        self._profile = self._preset = None
+        if profile is not None:
+            self._profile = profile.index
+            for resolution in profile.resolutions:
+                if getattr(resolution, 'active', False):
+                    self._preset = resolution.index
+                    self._dpi = resolution.dpi[0]
+
+        if now - self._last_snapshot >= SNAPSHOT_INTERVAL:
+            self._last_snapshot = now
+            self.snapshot()
+
+        return True  # keep the timeout
+
+    def snapshot(self):
+        if self._stopped:
+            return
+        try:
+            self.stats.dump(self._path)
+        except OSError as e:
+            logger.warning('unable to write usage snapshot: {}'.format(e))
+
+
+def export(paths, format='json', output=None):
+    """
+    Write the snapshots as JSON (an object per device) or CSV.
+    """
+    result = {}
+    for path in paths:
+        name = os.path.basename(path)[len('usage-'):-len('.bin')]
+        result[name] = UsageStats.load(path)
+
+    if format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(('device', 'metric', 'key', 'value'))
+        for name, stats in result.items():
+            for row in stats.rows():
+                writer.writerow((name,) + row)
+    else:
+        json.dump(
+            {name: stats.to_dict() for name, stats in result.items()},
+            output, indent=2)
+        output.write('\n')
@@ -0,0 +1,773 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Asynchronous API for ROG mice.
+
+ratbag is driven by a GLib main loop, so every device operation is executed
+on the thread running that loop and the result is handed back to asyncio
+as a future. The blocking writes (``commit()``, ``set_profile()``) run on
+the I/O worker of each device instead, so the ones of several devices
+run at the same time and don't hold up the loop:
+
+    import asyncio
+    from rog import api
+
+    async def main():
+        for session in await api.discover():
+            print(await api.get_state(session))
+            await api.set_dpi(session, 1600, preset=0)
+            await api.commit(session)
+
+    asyncio.run(main())
+"""
+
+import asyncio
+import concurrent.futures
+import sys
+import threading
+import time
+
+from gi.repository import GLib
+
+try:
+    import ratbag
+except ImportError:
+    sys.path.append('ratbag-python')
+    import ratbag
+
+from . import logger, metrics
+from .devices import (
+    DeviceFilter, get_device_path, group_nodes, has_battery, is_vendor_node,
+    read_battery, read_hid_id, read_hid_info)
+from .utils import load_config
+
+# how long ratbag is given to report the connected devices
+DISCOVERY_TIMEOUT = 1.0
+
+# ms to wait for all hidraw nodes of a plugged in device
+HOTPLUG_DELAY = 500
+
+# how many times a failed commit is repeated
+COMMIT_RETRIES = 1
+
+# DPI preset switches: name -> (step, wrap around)
+DPI_STEPS = {
+    'up': (1, False),
+    'down': (-1, False),
+    'cycle': (1, True),
+}
+
+
+class RatbagBridge(object):
+    """
+    Runs ratbag on a GLib main loop and executes calls on it.
+
+    With ``thread=True`` the main loop runs on a dedicated thread,
+    otherwise the thread calling ``start()`` is expected to run the default
+    GLib main loop itself (e.g. ``Gtk.main()``).
+
+    Only the hidraw nodes matching ``device_filter`` are handed to ratbag,
+    by default the supported devices (or the ones from the configuration).
+    Every physical device gets its own ratbag instance, the devices plugged
+    in later are picked up from udev (requires pyudev). The instances are
+    started on an enumeration thread, so the loop thread (e.g. the GTK one)
+    never waits for the probing I/O; the sessions are handed back to it.
+    The HID traffic is written to ``recorder`` (a ``HidRecorder``) if set,
+    tagged with its hidraw node. With ``replay`` (a ``HidReplay``)
+    a capture is used instead of the devices, its realtime timing requires
+    the dedicated loop thread.
+    """
+    def __init__(self, thread=True, device_filter=None, recorder=None, replay=None):
+        self._use_thread = thread
+        self._device_filter = device_filter or get_device_filter()
+        self._recorder = recorder or _capture['recorder']
+        self._replay = replay or _capture['replay']
+        self._thread = None
+        self._mainloop = None
+        self._ratbags = {}  # device path, node or replayed device -> ratbag
+        self._nodes = {}  # nodes handed to ratbag -> key of their ratbag
+        self._plugged = set()  # nodes waiting to be handed to ratbag
+        self._monitor = None
+        self._started = False
+        self._enumerator = None
+        self._enumerating = 0  # ratbag instances being started
+        self._enumerated = threading.Condition()
+        self._sessions = []
+        self._callbacks = []
+        self.started_at = None
+
+    @property
+    def sessions(self):
+        return list(self._sessions)
+
+    def connect(self, callback):
+        """
+        Register ``callback(session)``, called on the loop thread
+        for every device found by ratbag.
+        """
+        self._callbacks.append(callback)
+        for session in self._sessions:
+            self.call(callback, session)
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+
+        if self._use_thread:
+            self._mainloop = GLib.MainLoop()
+            self._thread = threading.Thread(
+                target=self._mainloop.run, name='ratbag', daemon=True)
+            self._thread.start()
+        else:
+            self._thread = threading.current_thread()
+
+        self.call(self._start_ratbag).result()
+
+    def stop(self):
+        if self._mainloop is not None:
+            self._mainloop.quit()
+            self._thread.join()
+            self._mainloop = None
+
+    def is_loop_thread(self):
+        return threading.current_thread() is self._thread
+
+    def wait_enumerated(self, timeout=None):
+        """
+        Block until the started ratbag instances have added their devices,
+        returns False on timeout.
+        """
+        with self._enumerated:
+            return self._enumerated.wait_for(lambda: not self._enumerating, timeout)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Execute ``func`` on the loop thread.
+
+        Returns a ``concurrent.futures.Future`` with the result.
+        """
+        future = concurrent.futures.Future()
+
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            return False  # don't repeat the idle callback
+
+        if self.is_loop_thread():
+            run()
+        else:
+            GLib.idle_add(run)
+        return future
+
+    def _start_ratbag(self):
+        self.started_at = time.monotonic()
+
+        if self._replay is not None:
+            logger.debug('replaying {}'.format(self._replay.name))
+            if self._replay.realtime and not self._use_thread:
+                logger.warning('realtime replay would block the main loop, disabled')
+                self._replay.realtime = False
+            for index, group in enumerate(self._replay.groups()):
+                self._create_ratbag(
+                    '{}:{}'.format(self._replay.name, index), {'emulators': group})
+            return
+
+        if self._recorder is not None:
+            from .record import attach
+            attach(self._recorder)
+
+        self._start_monitor()
+        nodes = self._device_filter.find_nodes()
+        if not nodes:
+            logger.info('no matching devices, waiting for one to be plugged in')
+            return
+        self._add_nodes(nodes)
+
+    def _add_nodes(self, nodes):
+        nodes = [node for node in nodes if node not in self._nodes]
+
+        for group in group_nodes(nodes):
+            logger.debug('matching hidraw nodes: {}'.format(', '.join(group)))
+
+            if self._recorder is not None:
+                for node in group:
+                    self._recorder.add_device(read_hid_info(node))
+
+            key = get_device_path(group[0])
+            self._nodes.update((node, key) for node in group)
+            self._create_ratbag(key, {'device-paths': group}, group)
+
+    def _create_ratbag(self, key, config, nodes=()):
+        if self._enumerator is None:
+            from .worker import DeviceWorker
+            self._enumerator = DeviceWorker('enumeration', min_interval=0)
+
+        with self._enumerated:
+            self._enumerating += 1
+        self._enumerator.submit(
+            self._enumerate, config, nodes,
+            callback=lambda r, error: self._on_enumerated(key, r, error))
+
+    def _enumerate(self, config, nodes):
+        """
+        Create and start a ratbag instance, runs on the enumeration thread.
+        """
+        metrics.wrap_driver_io()
+        start = time.monotonic()
+        r = ratbag.Ratbag.create(config)
+        r.connect('device-added', self._on_device_added, start, nodes)
+        r.start()
+        metrics.observe('enumeration', time.monotonic() - start)
+        return r
+
+    def _on_enumerated(self, key, r, error):
+        if error is not None:
+            logger.error('unable to start ratbag: {}'.format(error))
+        elif key in self._nodes.values() or self._replay is not None:
+            self._ratbags[key] = r  # replaces the one of a re-plugged device
+
+        # the sessions added during the start are already handed over
+        with self._enumerated:
+            self._enumerating -= 1
+            self._enumerated.notify_all()
+
+    def _start_monitor(self):
+        try:
+            import pyudev
+        except ImportError:
+            logger.warning('pyudev not found, devices plugged in later are not detected')
+            return
+
+        self._monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        self._monitor.filter_by('hidraw')
+        self._monitor.start()
+        GLib.io_add_watch(
+            self._monitor.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._on_uevent)
+
+    def _on_uevent(self, fd, condition):
+        while True:
+            device = self._monitor.poll(timeout=0)
+            if device is None:
+                break
+
+            node = device.device_node
+            if node is None:
+                continue
+            if device.action == 'add' and self._device_filter.match(node):
+                logger.debug('{} plugged in'.format(node))
+                if not self._plugged:
+                    # the interfaces of a device appear one by one
+                    GLib.timeout_add(HOTPLUG_DELAY, self._on_plugged)
+                self._plugged.add(node)
+            elif device.action == 'remove':
+                self._plugged.discard(node)
+                self._remove_node(node)
+        return True  # keep the watch
+
+    def _remove_node(self, node):
+        key = self._nodes.pop(node, None)
+        if key is None:
+            return
+
+        logger.debug('{} unplugged'.format(node))
+        if key not in self._nodes.values():
+            self._ratbags.pop(key, None)
+        for session in [s for s in self._sessions if node in s.nodes]:
+            self._sessions.remove(session)
+            session.remove()
+
+    def _on_plugged(self):
+        nodes = sorted(self._plugged)
+        self._plugged.clear()
+        self._add_nodes(nodes)
+        return False  # don't repeat the timeout
+
+    def _on_device_added(self, r, device, start, nodes):
+        logger.debug('device added: {}'.format(device.name))
+        metrics.observe('device_added', time.monotonic() - start)
+        # emitted on the enumeration thread while ratbag starts
+        self.call(self._add_session, device, nodes)
+
+    def _add_session(self, device, nodes):
+        session = DeviceSession(self, device, nodes)
+        self._sessions.append(session)
+        for callback in self._callbacks:
+            callback(session)
+
+
+class DeviceSession(object):
+    """
+    Reusable handle of a single device.
+
+    The plain methods must be called on the loop thread (e.g. from
+    ``RatbagBridge.connect`` callbacks or GTK handlers), use ``run()``
+    or the module level coroutines from anywhere else.
+
+    The setters only change values which differ from the ones read from
+    the device and remember them, ``commit()`` does nothing if there are
+    no such changes.
+
+    The operations doing device I/O, ``commit()`` and ``set_profile()``,
+    may also run on the device ``worker``, every other change of the
+    ratbag objects is done on the loop thread. The session's own state is
+    guarded by a lock: a commit takes the remembered changes when it
+    starts, so values changed while it runs are written by the next one.
+    "notify" handlers may be called on the worker thread, see
+    ``is_loop_thread()``.
+
+    ``nodes`` are the hidraw nodes of the device, empty for a replay.
+    """
+    def __init__(self, bridge, device, nodes=()):
+        self._bridge = bridge
+        self._worker = None
+        self._lock = threading.Lock()
+        self._dirty = set()  # indices of the changed profiles
+        self._dpi_presets = None
+        self._battery = None
+        self._removed_callbacks = []
+        self.removed = False
+        self.device = device
+        self.nodes = list(nodes)
+
+    def __repr__(self):
+        return '<DeviceSession {}>'.format(self.name)
+
+    @property
+    def name(self):
+        return self.device.name
+
+    @property
+    def profiles(self):
+        return self.device.profiles
+
+    @property
+    def active_profile(self):
+        for profile in self.device.profiles:
+            if profile.active:
+                return profile
+
+    @property
+    def worker(self):
+        """
+        I/O worker of the device, for running blocking operations
+        outside of the loop thread.
+        """
+        if self._worker is None:
+            from .worker import DeviceWorker
+            self._worker = DeviceWorker(self.name)
+        return self._worker
+
+    @property
+    def has_battery(self):
+        """
+        Whether it's a wireless device reporting its battery charge.
+        """
+        return any(has_battery(read_hid_id(node)) for node in self.nodes)
+
+    @property
+    def battery(self):
+        """
+        Battery charge in % from the last ``read_battery()``,
+        None if it wasn't read yet.
+        """
+        with self._lock:
+            return self._battery
+
+    def read_battery(self):
+        """
+        Read the battery charge in % from the device, None if it has
+        no battery. Blocking, run it on the ``worker``.
+        """
+        if not self.has_battery:
+            return None
+        for node in self.nodes:
+            if is_vendor_node(node):
+                break
+        else:
+            raise OSError('{}: vendor interface not found'.format(self.name))
+
+        start = time.monotonic()
+        try:
+            battery = read_battery(node)
+        except OSError:
+            metrics.inc('hid_errors')
+            raise
+        metrics.observe('read', time.monotonic() - start)
+        with self._lock:
+            self._battery = battery
+        return battery
+
+    def is_loop_thread(self):
+        return self._bridge.is_loop_thread()
+
+    def connect_removed(self, callback):
+        """
+        Register ``callback(session)``, called on the loop thread
+        when the device is unplugged.
+        """
+        self._removed_callbacks.append(callback)
+
+    def remove(self):
+        """
+        Forget the unplugged device: the worker is stopped, the queued
+        jobs are dropped and the ``connect_removed`` callbacks are called.
+        """
+        self.removed = True
+        if self._worker is not None:
+            self._worker.stop(wait=False)
+        for callback in self._removed_callbacks:
+            callback(self)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Await ``func(*args, **kwargs)`` executed on the loop thread.
+        """
+        return asyncio.wrap_future(self._bridge.call(func, *args, **kwargs))
+
+    def run_io(self, func, *args, **kwargs):
+        """
+        Await ``func(*args, **kwargs)`` executed on the device ``worker``.
+        """
+        future = concurrent.futures.Future()
+
+        def done(result, error):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        self.worker.submit(func, *args, callback=done, **kwargs)
+        return asyncio.wrap_future(future)
+
+    def state(self):
+        """
+        Current settings of the device as a plain dict.
+        """
+        profile = self.active_profile
+        state = {
+            'name': self.name,
+            'profiles': len(self.device.profiles),
+            'profile': None,
+        }
+        if profile is None:
+            return state
+
+        state.update({
+            'profile': profile.index,
+            'dpi': [resolution.dpi[0] for resolution in profile.resolutions],
+            'report_rate': profile.report_rate,
+            'angle_snapping': bool(profile.angle_snapping),
+            'debounce': profile.debounce,
+            'buttons': [str(button.action) for button in profile.buttons],
+            'leds': [{
+                'mode': led.mode.name,
+                'color': '#{:02x}{:02x}{:02x}'.format(*led.color),
+                'brightness': led.brightness,
+            } for led in profile.leds],
+        })
+        return state
+
+    @property
+    def dirty(self):
+        """
+        Indices of the profiles with changes which haven't been committed yet.
+        """
+        with self._lock:
+            return sorted(self._dirty)
+
+    def mark_dirty(self, profile):
+        """
+        Remember a change of ``profile`` done outside of the setters.
+        """
+        with self._lock:
+            self._dirty.add(profile.index)
+
+    @property
+    def dpi_presets(self):
+        """
+        DPI of every preset of the active profile, kept in memory
+        until the presets or the profile are changed.
+        """
+        with self._lock:
+            if self._dpi_presets is None:
+                profile = self.active_profile
+                self._dpi_presets = tuple(
+                    resolution.dpi[0] for resolution in profile.resolutions
+                ) if profile is not None else ()
+            return self._dpi_presets
+
+    @property
+    def dpi_preset(self):
+        """
+        Index of the active DPI preset.
+        """
+        profile = self.active_profile
+        if profile is not None:
+            for resolution in profile.resolutions:
+                if resolution.active:
+                    return resolution.index
+        return 0
+
+    def find_dpi_preset(self, action):
+        """
+        Index of the DPI preset selected by ``action``:
+        a name from ``DPI_STEPS`` or a preset number.
+        """
+        count = len(self.dpi_presets)
+        if not count:
+            raise ValueError('device has no DPI presets')
+
+        if action in DPI_STEPS:
+            step, wrap = DPI_STEPS[action]
+            preset = self.dpi_preset + step
+            if wrap:
+                return preset % count
+            return min(max(preset, 0), count - 1)
+
+        try:
+            preset = int(action)
+        except ValueError:
+            raise ValueError('unknown DPI action: {}'.format(action))
+        if not 0 <= preset < count:
+            raise ValueError('no such DPI preset: {}'.format(preset))
+        return preset
+
+    def set_profile(self, index):
+        for profile in self.device.profiles:
+            if profile.index == index and not profile.active:
+                logger.debug('switching profile to {}'.format(index))
+                profile.set_active()
+                with self._lock:
+                    self._dpi_presets = None
+
+    def set_dpi(self, dpi, preset=0):
+        profile = self.active_profile
+        for resolution in profile.resolutions:
+            if resolution.index == preset and tuple(resolution.dpi) != (dpi, dpi):
+                resolution.set_dpi((dpi, dpi))
+                self.mark_dirty(profile)
+                with self._lock:
+                    self._dpi_presets = None
+
+    def select_dpi_preset(self, preset):
+        """
+        Make ``preset`` the active DPI preset, the DPI values are left as they are.
+        """
+        profile = self.active_profile
+        for resolution in profile.resolutions:
+            if resolution.index == preset and not resolution.active:
+                logger.debug('selecting DPI preset {}'.format(preset))
+                resolution.set_active()
+                self.mark_dirty(profile)
+
+    def switch_dpi_preset(self, action, callback=None):
+        """
+        Select a DPI preset by ``action`` (see ``find_dpi_preset()``)
+        and commit it on the I/O worker.
+
+        Returns ``(preset, dpi)`` right away from the preset table,
+        ``callback(result, error)`` is called once it's written.
+        Must be called on the loop thread.
+        """
+        preset = self.find_dpi_preset(action)
+        self.select_dpi_preset(preset)
+        self.commit_later(callback)
+        return preset, self.dpi_presets[preset]
+
+    def set_report_rate(self, rate):
+        profile = self.active_profile
+        if profile.report_rate != rate:
+            profile.set_report_rate(rate)
+            self.mark_dirty(profile)
+
+    def set_angle_snapping(self, snapping):
+        profile = self.active_profile
+        if bool(profile.angle_snapping) != bool(snapping):
+            profile.set_angle_snapping(snapping)
+            self.mark_dirty(profile)
+
+    def set_debounce(self, debounce):
+        profile = self.active_profile
+        if profile.debounce != debounce:
+            profile.set_debounce(debounce)
+            self.mark_dirty(profile)
+
+    def set_button(self, index, action):
+        profile = self.active_profile
+        for button in profile.buttons:
+            if button.index == index and str(button.action) != str(action):
+                button.set_action(action)
+                self.mark_dirty(profile)
+
+    def set_leds(self, mode=None, color=None, brightness=None, index=None):
+        """
+        Change LED settings, all LEDs are changed if ``index`` is None.
+        """
+        profile = self.active_profile
+        for led in profile.leds:
+            if index is not None and led.index != index:
+                continue
+
+            if mode is not None and led.mode != mode:
+                led.set_mode(mode)
+                self.mark_dirty(profile)
+            if color is not None and tuple(led.color) != tuple(color):
+                led.set_color(color)
+                self.mark_dirty(profile)
+            if brightness is not None and led.brightness != brightness:
+                led.set_brightness(brightness)
+                self.mark_dirty(profile)
+
+    def commit_later(self, callback=None, priority=None):
+        """
+        Commit on the device worker, ``callback(result, error)`` is called
+        on the loop thread. A queued commit of the same priority is
+        replaced, it would write the same changes.
+        """
+        from .worker import INTERACTIVE
+
+        if priority is None:
+            priority = INTERACTIVE
+        self.worker.submit(
+            self.commit, priority=priority, callback=callback,
+            key='commit-{}'.format(priority))
+
+    def commit(self):
+        """
+        Write the changes to the device, nothing at all if there are
+        no changes. ratbag decides which reports a commit writes.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+
+        if not dirty:
+            logger.debug('no changes, nothing to commit')
+            return
+        logger.debug('committing changes of profiles {}'.format(
+            ', '.join(str(profile) for profile in sorted(dirty))))
+
+        for attempt in range(COMMIT_RETRIES + 1):
+            if attempt:
+                metrics.inc('hid_retries')
+
+            # driver errors are swallowed by the signal emission,
+            # they're taken from the wrapped driver I/O instead
+            metrics.take_io_error()
+            start = time.monotonic()
+            try:
+                self.device.emit('commit', None)
+            except OSError as e:
+                if metrics.take_io_error() is None:
+                    metrics.inc('hid_errors')  # not raised by the wrapped I/O
+                error = e
+            else:
+                error = metrics.take_io_error()
+
+            if error is None:
+                metrics.observe('commit', time.monotonic() - start)
+                break
+
+            logger.debug('commit failed: {}'.format(error))
+            if attempt == COMMIT_RETRIES:
+                with self._lock:  # keep the changes for the next commit
+                    self._dirty.update(dirty)
+                raise error
+
+
+_bridge = None
+_bridge_lock = threading.Lock()
+_device_filter = None
+_capture = {'recorder': None, 'replay': None}
+
+
+def set_capture(recorder=None, replay=None):
+    """
+    Set the default recorder or replay, must be called before any bridge is started.
+    """
+    _capture.update(recorder=recorder, replay=replay)
+
+
+def set_device_filter(device_filter):
+    """
+    Set the default device filter, must be called before any bridge is started.
+    """
+    global _device_filter
+    _device_filter = device_filter
+
+
+def get_device_filter():
+    global _device_filter
+
+    if _device_filter is None:
+        _device_filter = DeviceFilter.from_config(load_config())
+    return _device_filter
+
+
+def get_bridge():
+    """
+    Shared bridge running ratbag on its own thread.
+    """
+    global _bridge
+
+    with _bridge_lock:
+        if _bridge is None:
+            _bridge = RatbagBridge(thread=True)
+            _bridge.start()
+    return _bridge
+
+
+async def discover(timeout=DISCOVERY_TIMEOUT):
+    """
+    Sessions of all connected devices.
+    """
+    loop = asyncio.get_running_loop()
+    bridge = await loop.run_in_executor(None, get_bridge)
+    await loop.run_in_executor(None, bridge.wait_enumerated, timeout)
+    elapsed = time.monotonic() - bridge.started_at
+    if elapsed < timeout:
+        await asyncio.sleep(timeout - elapsed)
+    return bridge.sessions
+
+
+async def get_state(session):
+    return await session.run(session.state)
+
+
+async def set_profile(session, index):
+    return await session.run_io(session.set_profile, index)
+
+
+async def set_dpi(session, dpi, preset=0):
+    return await session.run(session.set_dpi, dpi, preset)
+
+
+async def set_report_rate(session, rate):
+    return await session.run(session.set_report_rate, rate)
+
+
+async def set_leds(session, mode=None, color=None, brightness=None, index=None):
+    return await session.run(
+        session.set_leds, mode=mode, color=color,
+        brightness=brightness, index=index)
+
+
+async def commit(session):
+    return await session.run_io(session.commit)
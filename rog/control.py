@@ -0,0 +1,245 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Control interface of the running rogdrv.
+
+rogdrv listens on a UNIX socket for one command per line and replies
+with one line, "ok ..." or "error <message>":
+
+    dpi up|down|cycle|<preset>  -> ok <preset> <dpi>
+
+DPI switches select a preset from the table already held in memory,
+so the reply doesn't wait for the mouse; the selection is written by
+a regular commit on the device worker.
+
+The commands go to the most recently added device, the one shown
+in the tray.
+"""
+
+import os
+import socket
+
+from gi.repository import GLib
+
+from . import logger
+from .accel import EV_KEY, EVENT
+from .api import DPI_STEPS
+from .utils import get_runtime_dir
+
+SOCKET_NAME = 'rogdrv.sock'
+
+# seconds a client is given to send its command
+CLIENT_TIMEOUT = 1.0
+
+
+def get_socket_path():
+    return os.path.join(get_runtime_dir(), SOCKET_NAME)
+
+
+def send_command(command, path=None, timeout=2.0):
+    """
+    Send a command to the running rogdrv, returns its reply
+    or None if rogdrv isn't running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    with sock:
+        try:
+            sock.connect(path or get_socket_path())
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        try:
+            sock.sendall((command + '\n').encode())
+            with sock.makefile() as f:
+                reply = f.readline().strip()
+        except OSError as e:  # including socket.timeout
+            return 'error no reply from rogdrv: {}'.format(e)
+        return reply or 'error no reply from rogdrv'
+
+
+class ControlServer(object):
+    """
+    Executes the commands received on the control socket,
+    must be used on the GLib main loop thread. The clients are read
+    without blocking, a client which doesn't send its command within
+    ``CLIENT_TIMEOUT`` is disconnected.
+
+    ``callback(session, preset, dpi)`` registered with ``connect()``
+    is called on every DPI switch, before it's written to the device.
+    """
+    def __init__(self, path=None):
+        self._path = path or get_socket_path()
+        self._socket = None
+        self._sessions = []
+        self._callbacks = []
+
+    def add_session(self, session):
+        self._sessions.append(session)
+        session.connect_removed(self._sessions.remove)
+
+    def connect(self, callback):
+        self._callbacks.append(callback)
+
+    def start(self):
+        if os.path.exists(self._path):
+            if send_command('', self._path) is not None:
+                logger.warning('control socket {} is in use'.format(self._path))
+                return
+            os.unlink(self._path)  # left by a crashed instance
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self._path)
+        os.chmod(self._path, 0o600)
+        self._socket.listen()
+        self._socket.setblocking(False)
+        GLib.io_add_watch(
+            self._socket.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._on_accept)
+        logger.debug('listening on {}'.format(self._path))
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            os.unlink(self._path)
+
+    def _on_accept(self, fd, condition):
+        if self._socket is None:
+            return False  # stopped
+
+        try:
+            conn, _ = self._socket.accept()
+        except BlockingIOError:
+            return True
+
+        conn.setblocking(False)
+        client = {'conn': conn, 'data': b''}
+        client['watch'] = GLib.io_add_watch(
+            conn.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self._on_client, client)
+        client['timeout'] = GLib.timeout_add(
+            int(CLIENT_TIMEOUT * 1000), self._on_client_timeout, client)
+        return True  # keep the watch
+
+    def _on_client(self, fd, condition, client):
+        conn = client['conn']
+        try:
+            data = conn.recv(4096)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            logger.debug('control client failed: {}'.format(e))
+            data = b''
+
+        client['data'] += data
+        if b'\n' not in client['data'] and data:
+            return True  # wait for the rest of the line
+
+        GLib.source_remove(client['timeout'])
+        line = client['data'].split(b'\n', 1)[0].decode(errors='replace')
+        if data:
+            try:
+                conn.send((self.execute(line) + '\n').encode())
+            except OSError as e:
+                logger.debug('control client failed: {}'.format(e))
+        conn.close()
+        return False  # remove the watch
+
+    def _on_client_timeout(self, client):
+        logger.debug('control client timed out')
+        GLib.source_remove(client['watch'])
+        client['conn'].close()
+        return False  # don't repeat the timeout
+
+    def execute(self, line):
+        """
+        Execute a command, returns the reply.
+        """
+        args = line.split()
+        if not args:
+            return 'ok'
+
+        if args[0] == 'dpi' and len(args) == 2:
+            if not self._sessions:
+                return 'error no device'
+            return self._switch_dpi(self._sessions[-1], args[1])
+
+        return 'error unknown command: {}'.format(line.strip())
+
+    def _switch_dpi(self, session, action):
+        try:
+            preset, dpi = session.switch_dpi_preset(action, callback=self._on_switched)
+        except ValueError as e:
+            return 'error {}'.format(e)
+
+        logger.debug('DPI preset {} ({} DPI) selected'.format(preset, dpi))
+        for callback in self._callbacks:
+            callback(session, preset, dpi)
+        return 'ok {} {}'.format(preset, dpi)
+
+    def _on_switched(self, result, error):
+        if error is not None:
+            logger.error('unable to switch DPI preset: {}'.format(error))
+
+
+class DpiKeyTap(object):
+    """
+    Event tap running DPI switches on presses of the configured keys,
+    e.g. a spare button bound to an unused key code.
+    """
+    def __init__(self, server, keys):
+        self._server = server
+        self.keys = keys  # key code -> DPI action
+
+    @classmethod
+    def from_config(cls, server, config):
+        """
+        Keys from the [dpi] section: ``up``, ``down`` and ``cycle``
+        set to an evdev key name (e.g. BTN_TASK) or code.
+        Unknown keys are skipped with a warning.
+        """
+        keys = {}
+        if not config.has_section('dpi'):
+            return cls(server, keys)
+
+        try:
+            from evdev import ecodes
+        except ImportError:
+            logger.warning('python-evdev not found, DPI keys are disabled')
+            return cls(server, keys)
+
+        for action in DPI_STEPS:
+            name = config.get('dpi', action, fallback=None)
+            if not name:
+                continue
+            code = int(name) if name.isdigit() else ecodes.ecodes.get(name.upper())
+            if code is None:
+                logger.warning('unknown key for DPI {}: {}'.format(action, name))
+                continue
+            keys[code] = action
+        return cls(server, keys)
+
+    def __call__(self, data):
+        for _, _, type, code, value in EVENT.iter_unpack(data):
+            if type == EV_KEY and value == 1 and code in self.keys:
+                GLib.idle_add(self._execute, self.keys[code])
+
+    def _execute(self, action):
+        reply = self._server.execute('dpi {}'.format(action))
+        if not reply.startswith('ok'):
+            logger.warning('DPI {}: {}'.format(action, reply))
+        return False  # don't repeat the idle callback
@@ -0,0 +1,236 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Supported devices.
+"""
+
+import glob
+import os
+import select
+import time
+
+from . import logger
+
+# ASUSTek Computer, Inc.
+VENDOR_ID = '0b05'
+
+# name, USB product IDs (wired, RF receiver)
+DEVICES = (
+    ('ASUS ROG GX860 Buzzard Mouse', ('1816',)),
+    ('ASUS ROG Chakram', ('18e5', '18e3')),
+    ('ASUS ROG Chakram X (Origin)', ('1a1a', '1a18')),
+    ('ASUS ROG Gladius II', ('1845',)),
+    ('ASUS ROG Gladius II Core', ('18dd',)),
+    ('ASUS ROG Gladius II Origin', ('1877',)),
+    ('ASUS ROG Gladius II Origin PNK LTD', ('18cd',)),
+    ('ASUS ROG Gladius III', ('197b',)),
+    ('ASUS ROG Gladius III Wireless', ('197f', '197d')),
+    ('ASUS ROG Gladius III Wireless AimPoint', ('1a72', '1a70')),
+    ('ASUS ROG Keris Wireless', ('1960', '195e')),
+    ('ASUS ROG Keris Wireless AimPoint', ('1a68', '1a66')),
+    ('ASUS ROG Pugio', ('1846',)),
+    ('ASUS ROG Pugio II', ('1906', '1908')),
+    ('ASUS ROG Spatha X', ('1979', '1977')),
+    ('ASUS ROG Strix Carry', ('18b4',)),
+    ('ASUS ROG Strix Impact', ('1847',)),
+    ('ASUS ROG Strix Impact II', ('1851',)),
+    ('ASUS ROG Strix Impact II Electro Punk', ('1956',)),
+    ('ASUS ROG Strix Impact II Wireless', ('1949', '1947')),
+    ('ASUS TUF Gaming M3', ('1910',)),
+)
+
+
+# vendor request for the sleep timeout, battery charge and alert level
+BATTERY_REQUEST = b'\x12\x07'
+REPORT_SIZE = 64
+
+
+def get_product_ids():
+    return [pid for _, pids in DEVICES for pid in pids]
+
+
+def has_battery(ids):
+    """
+    Whether the (vendor ID, product ID) belongs to a wireless model,
+    both over its cable and over its RF receiver.
+    """
+    vid, pid = ids
+    return vid == VENDOR_ID and any(
+        pid in pids for _, pids in DEVICES if len(pids) > 1)
+
+
+def read_hid_id(node):
+    """
+    (vendor ID, product ID) of a hidraw node from sysfs, without opening it.
+    """
+    name = os.path.basename(node)
+    try:
+        with open(os.path.join('/sys/class/hidraw', name, 'device', 'uevent')) as f:
+            for line in f:
+                if line.startswith('HID_ID='):
+                    # HID_ID=0003:00000B05:00001910
+                    _, vid, pid = line.strip().split('=', 1)[1].split(':')
+                    return '{:04x}'.format(int(vid, 16)), '{:04x}'.format(int(pid, 16))
+    except (OSError, ValueError):
+        pass
+    return None, None
+
+
+def read_hid_info(node):
+    """
+    Identity of a hidraw node from sysfs: path, sysfs path of the physical
+    device, bus, vendor and product ID (as ints), name and the report
+    descriptor (hex).
+    """
+    info = {
+        'path': node, 'device': get_device_path(node),
+        'bus': 0, 'vid': 0, 'pid': 0, 'name': os.path.basename(node)}
+    device = os.path.join('/sys/class/hidraw', os.path.basename(node), 'device')
+    try:
+        with open(os.path.join(device, 'uevent')) as f:
+            for line in f:
+                key, _, value = line.strip().partition('=')
+                if key == 'HID_ID':
+                    bus, vid, pid = value.split(':')
+                    info.update(bus=int(bus, 16), vid=int(vid, 16), pid=int(pid, 16))
+                elif key == 'HID_NAME':
+                    info['name'] = value
+        with open(os.path.join(device, 'report_descriptor'), 'rb') as f:
+            info['report_descriptor'] = f.read().hex()
+    except (OSError, ValueError) as e:
+        info.setdefault('report_descriptor', '')
+        logger.debug('{}: incomplete device info: {}'.format(node, e))
+    return info
+
+
+def is_vendor_node(node):
+    """
+    Whether the hidraw node is the vendor defined interface
+    taking the ASUS requests (usage page 0xFFxx).
+    """
+    name = os.path.basename(node)
+    try:
+        with open(os.path.join(
+                '/sys/class/hidraw', name, 'device', 'report_descriptor'), 'rb') as f:
+            desc = f.read(3)
+    except OSError:
+        return False
+    # Usage Page (2 bytes)
+    return desc[:1] == b'\x06' and desc[2:3] == b'\xff'
+
+
+def read_battery(node, timeout=1.0):
+    """
+    Battery charge in % read from the vendor interface of a wireless mouse,
+    blocks for up to ``timeout`` seconds.
+    """
+    fd = os.open(node, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        os.write(fd, BATTERY_REQUEST.ljust(REPORT_SIZE, b'\0'))
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('no battery report from {}'.format(node))
+            if not select.select([fd], [], [], remaining)[0]:
+                continue
+            # other reports (e.g. the ones requested by ratbag) are skipped
+            response = os.read(fd, REPORT_SIZE)
+            if response[:2] == BATTERY_REQUEST:
+                # sleep timeout, charge in quarters, alert level
+                return response[5] * 25
+    finally:
+        os.close(fd)
+
+
+def get_device_path(node):
+    """
+    sysfs path of the physical device of a hidraw node,
+    the nodes of the interfaces of one device share it.
+    """
+    hid = os.path.realpath(os.path.join(
+        '/sys/class/hidraw', os.path.basename(node), 'device'))
+    if not os.path.exists(hid):
+        return node
+    # .../<usb device>/<usb interface>/<hid device>
+    return os.path.dirname(os.path.dirname(hid))
+
+
+def group_nodes(nodes):
+    """
+    hidraw nodes grouped by their physical device.
+    """
+    groups = {}
+    for node in nodes:
+        groups.setdefault(get_device_path(node), []).append(node)
+    return list(groups.values())
+
+
+class DeviceFilter(object):
+    """
+    Selects the hidraw nodes which are handed to ratbag.
+
+    A node matches if it's listed in ``nodes`` or its IDs are listed in
+    ``ids`` (``(vendor ID, product ID)`` pairs). By default these are
+    the supported devices.
+    """
+    def __init__(self, ids=None, nodes=None):
+        if not ids and not nodes:
+            ids = [(VENDOR_ID, pid) for pid in get_product_ids()]
+        self.ids = set(ids or [])
+        self.nodes = set(os.path.realpath(node) for node in nodes or [])
+
+    @classmethod
+    def parse_id(cls, value):
+        """
+        Parse "vid:pid" in hex.
+        """
+        vid, sep, pid = value.lower().partition(':')
+        try:
+            if not sep:
+                raise ValueError
+            return '{:04x}'.format(int(vid, 16)), '{:04x}'.format(int(pid, 16))
+        except ValueError:
+            raise ValueError(
+                'Invalid device "{}", vid:pid in hex expected'.format(value)) from None
+
+    @classmethod
+    def from_config(cls, config, devices=None, hidraw=None):
+        """
+        Filter from the command line values, or from the [devices] section
+        of the configuration if they're not set:
+
+            [devices]
+            match = 0b05:1910 0b05:1947
+            hidraw = /dev/hidraw3
+        """
+        if not devices and not hidraw and config.has_section('devices'):
+            devices = config.get('devices', 'match', fallback='').split()
+            hidraw = config.get('devices', 'hidraw', fallback='').split()
+
+        return cls(
+            ids=[cls.parse_id(device) for device in devices or []],
+            nodes=hidraw)
+
+    def match(self, node):
+        node = os.path.realpath(node)
+        return node in self.nodes or read_hid_id(node) in self.ids
+
+    def find_nodes(self):
+        return [
+            node for node in sorted(glob.glob('/dev/hidraw*'))
+            if self.match(node)]
@@ -0,0 +1,278 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Host-side profile library.
+
+The library keeps any number of named profiles on the host and uses the
+onboard profile slots of the mouse as a cache: activating a profile which
+is already stored in a slot only switches to it, otherwise the least
+recently used slot is overwritten, the active one only if there's no
+other. A slot whose contents aren't in the library yet (e.g. a profile
+tuned by hand) is saved as ``slot-N`` before it's overwritten. Slots are
+compared by the hash of their contents as read by ratbag, so a slot which
+already holds the right data is never written again.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+try:
+    import ratbag
+except ImportError:
+    sys.path.append('ratbag-python')
+    import ratbag
+
+from . import logger
+from .utils import get_config_dir, get_data_dir
+
+
+def action_to_dict(action):
+    if isinstance(action, ratbag.ActionButton):
+        return {'type': 'button', 'button': action.button}
+    if isinstance(action, ratbag.ActionKey):
+        return {'type': 'key', 'key': action.key}
+    if isinstance(action, ratbag.ActionSpecial):
+        return {'type': 'special', 'special': action.special.name}
+    return None  # macros etc. are not stored
+
+
+def action_from_dict(data):
+    if data['type'] == 'button':
+        return ratbag.ActionButton.create(data['button'])
+    if data['type'] == 'key':
+        return ratbag.ActionKey.create(data['key'])
+    if data['type'] == 'special':
+        return ratbag.ActionSpecial.create(
+            getattr(ratbag.ActionSpecial.Special, data['special']))
+
+
+def profile_to_dict(profile):
+    """
+    Settings of a ratbag profile as a plain dict.
+    """
+    return {
+        'dpi': [resolution.dpi[0] for resolution in profile.resolutions],
+        'report_rate': profile.report_rate,
+        'angle_snapping': bool(profile.angle_snapping),
+        'debounce': profile.debounce,
+        'buttons': [action_to_dict(button.action) for button in profile.buttons],
+        'leds': [{
+            'mode': led.mode.name,
+            'color': list(led.color),
+            'brightness': led.brightness,
+        } for led in profile.leds],
+    }
+
+
+def profile_from_dict(profile, data):
+    """
+    Apply settings from ``profile_to_dict()`` to a ratbag profile.
+
+    Only the values which differ are changed, returns whether
+    there were any.
+    """
+    changed = False
+
+    for resolution, dpi in zip(profile.resolutions, data['dpi']):
+        if tuple(resolution.dpi) != (dpi, dpi):
+            resolution.set_dpi((dpi, dpi))
+            changed = True
+
+    for field in ('report_rate', 'angle_snapping', 'debounce'):
+        if getattr(profile, field) != data[field]:
+            getattr(profile, 'set_' + field)(data[field])
+            changed = True
+
+    for button, action in zip(profile.buttons, data['buttons']):
+        if action is not None and action_to_dict(button.action) != action:
+            button.set_action(action_from_dict(action))
+            changed = True
+
+    for led, led_data in zip(profile.leds, data['leds']):
+        mode = getattr(ratbag.Led.Mode, led_data['mode'])
+        if led.mode != mode:
+            led.set_mode(mode)
+            changed = True
+        if list(led.color) != led_data['color']:
+            led.set_color(tuple(led_data['color']))
+            changed = True
+        if led.brightness != led_data['brightness']:
+            led.set_brightness(led_data['brightness'])
+            changed = True
+
+    return changed
+
+
+def profile_hash(data):
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class SlotCache(object):
+    """
+    LRU order of the onboard profile slots.
+
+    ``order`` lists slot indexes from the least to the most recently used,
+    slots which were never used by the library are evicted first.
+    The ``active`` slot is only evicted if it's the only one.
+    """
+    def __init__(self, order=None):
+        self.order = list(order or [])
+
+    def touch(self, slot):
+        if slot in self.order:
+            self.order.remove(slot)
+        self.order.append(slot)
+
+    def victim(self, slots, active=None):
+        candidates = [slot for slot in slots if slot != active] or list(slots)
+        for slot in candidates:
+            if slot not in self.order:
+                return slot
+        for slot in self.order:
+            if slot in candidates:
+                return slot
+
+
+class ProfileLibrary(object):
+    """
+    Named profiles stored as JSON files in the configuration directory.
+    """
+    def __init__(self, path=None, state_path=None):
+        self._path = path or os.path.join(get_config_dir(), 'profiles')
+        # kept out of the profiles directory, any profile name is allowed
+        self._state_path = state_path or os.path.join(get_data_dir(), 'slots.json')
+        os.makedirs(self._path, exist_ok=True)
+
+        old_state_path = os.path.join(self._path, 'slots.json')
+        if path is None and not os.path.exists(self._state_path) and os.path.exists(old_state_path):
+            os.replace(old_state_path, self._state_path)
+
+    def _profile_path(self, name):
+        if not name or os.sep in name or name.startswith('.'):
+            raise ValueError('Invalid profile name: {}'.format(name))
+        return os.path.join(self._path, name + '.json')
+
+    def names(self):
+        return sorted(
+            filename[:-len('.json')] for filename in os.listdir(self._path)
+            if filename.endswith('.json'))
+
+    def load(self, name):
+        try:
+            with open(self._profile_path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(name)
+
+    def save(self, name, data):
+        with open(self._profile_path(name), 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def delete(self, name):
+        try:
+            os.remove(self._profile_path(name))
+        except FileNotFoundError:
+            raise KeyError(name)
+
+    def _load_cache(self, session):
+        try:
+            with open(self._state_path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        return SlotCache(state.get(session.name))
+
+    def _save_cache(self, session, cache):
+        try:
+            with open(self._state_path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        state[session.name] = cache.order
+        with open(self._state_path, 'w') as f:
+            json.dump(state, f)
+
+    def _backup(self, profile):
+        """
+        Save the contents of a slot which isn't in the library yet,
+        returns the name it's saved under or None.
+        """
+        data = profile_to_dict(profile)
+        if profile_hash(data) in {profile_hash(self.load(name)) for name in self.names()}:
+            return None
+
+        names = set(self.names())
+        name = 'slot-{}'.format(profile.index)
+        suffix = 1
+        while name in names:
+            suffix += 1
+            name = 'slot-{}-{}'.format(profile.index, suffix)
+        self.save(name, data)
+        return name
+
+    def slots(self, session):
+        """
+        Name of the library profile held by each slot (or None).
+        """
+        hashes = {profile_hash(self.load(name)): name for name in self.names()}
+        return {
+            profile.index: hashes.get(profile_hash(profile_to_dict(profile)))
+            for profile in session.profiles}
+
+    def activate(self, session, name):
+        """
+        Make a library profile active, writing it to a slot only if needed.
+
+        Must be called on the ratbag loop thread.
+        """
+        data = self.load(name)
+        wanted = profile_hash(data)
+        cache = self._load_cache(session)
+
+        slot = None
+        for profile in session.profiles:
+            if profile_hash(profile_to_dict(profile)) == wanted:
+                slot = profile
+                logger.debug('profile {} is cached in slot {}'.format(name, slot.index))
+                break
+
+        if slot is None:
+            active = session.active_profile
+            index = cache.victim(
+                [profile.index for profile in session.profiles],
+                active.index if active is not None else None)
+            for profile in session.profiles:
+                if profile.index == index:
+                    slot = profile
+
+            backup = self._backup(slot)
+            if backup is not None:
+                logger.info('slot {} saved as library profile {}'.format(slot.index, backup))
+            logger.debug('writing profile {} to slot {}'.format(name, slot.index))
+            if profile_from_dict(slot, data):
+                session.mark_dirty(slot)
+            session.commit()
+
+        if not slot.active:
+            session.set_profile(slot.index)
+
+        cache.touch(slot.index)
+        self._save_cache(session, cache)
+        return slot.index
@@ -0,0 +1,285 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Prometheus text format metrics.
+
+Latencies and error counters are always collected (it's just a few
+additions), they are only exported when ``MetricsExporter`` is enabled.
+HID errors are counted by wrapping the I/O methods of the ratbag drivers,
+because exceptions raised inside the drivers are swallowed by the GObject
+signal emission and never reach rogdrv.
+Device values are copied from the state ratbag already holds (the battery
+charge only once something else, e.g. the report rate policy, read it),
+so exporting never causes any device I/O.
+"""
+
+import bisect
+import functools
+import http.server
+import os
+import threading
+
+from . import logger
+
+# histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HISTOGRAMS = {
+    'enumeration': 'Time to create and start ratbag',
+    'device_added': 'Time from ratbag start until the device was added',
+    'read': 'Time to read a value from the device',
+    'commit': 'Time to commit changes to the device',
+}
+
+COUNTERS = {
+    'hid_errors': 'HID I/O errors',
+    'hid_retries': 'Retried HID operations',
+}
+
+# HID I/O methods of the ratbag driver base class
+DRIVER_IO = ('send', 'recv', 'hid_get_feature', 'hid_set_feature')
+
+GAUGES = {
+    'active_profile': 'Index of the active profile',
+    'dpi': 'DPI of a preset of the active profile',
+    'report_rate_hz': 'Report rate of the active profile',
+    'battery_percent': 'Battery charge',
+    'connected': 'Whether the device is connected',
+}
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {name: Histogram() for name in HISTOGRAMS}
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._gauges = {}  # (name, labels) -> value
+        self.version = 0
+
+    def observe(self, name, value):
+        with self._lock:
+            self._histograms[name].observe(value)
+            self.version += 1
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+            self.version += 1
+
+    def set(self, name, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            if value is None:
+                self._gauges.pop((name, labels), None)
+            else:
+                self._gauges[(name, labels)] = value
+            self.version += 1
+
+    def render(self):
+        lines = []
+
+        def format_labels(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join(
+                '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels) + '}'
+
+        with self._lock:
+            for name, help in GAUGES.items():
+                lines.append(f'# HELP rogdrv_{name} {help}')
+                lines.append(f'# TYPE rogdrv_{name} gauge')
+                for (gauge, labels), value in sorted(self._gauges.items()):
+                    if gauge == name:
+                        lines.append(f'rogdrv_{name}{format_labels(labels)} {value}')
+
+            for name, help in COUNTERS.items():
+                lines.append(f'# HELP rogdrv_{name}_total {help}')
+                lines.append(f'# TYPE rogdrv_{name}_total counter')
+                lines.append(f'rogdrv_{name}_total {self._counters[name]}')
+
+            for name, help in HISTOGRAMS.items():
+                histogram = self._histograms[name]
+                lines.append(f'# HELP rogdrv_{name}_seconds {help}')
+                lines.append(f'# TYPE rogdrv_{name}_seconds histogram')
+                cumulative = 0
+                for le, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'rogdrv_{name}_seconds_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f'rogdrv_{name}_seconds_sum {histogram.sum}')
+                lines.append(f'rogdrv_{name}_seconds_count {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+observe = registry.observe
+inc = registry.inc
+
+_io_errors = threading.local()
+_io_wrapped = False
+
+
+def _count_errors(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except OSError as e:
+            inc('hid_errors')
+            _io_errors.last = e
+            raise
+    return wrapper
+
+
+def wrap_driver_io():
+    """
+    Count the errors of the ratbag driver I/O, must be called before ratbag is started.
+    """
+    global _io_wrapped
+
+    if _io_wrapped:
+        return
+    _io_wrapped = True
+
+    try:
+        from ratbag.driver import Rodent
+    except ImportError:
+        logger.debug('ratbag driver I/O not found, HID errors are not counted')
+        return
+
+    for name in DRIVER_IO:
+        func = getattr(Rodent, name, None)
+        if func is not None:
+            setattr(Rodent, name, _count_errors(func))
+
+
+def take_io_error():
+    """
+    Last HID I/O error of the calling thread since the previous call, or None.
+    """
+    error = getattr(_io_errors, 'last', None)
+    _io_errors.last = None
+    return error
+
+
+def update_device(session, connected=True):
+    """
+    Copy the cached state of a session into the gauges.
+    """
+    device = session.name
+    state = session.state()
+    registry.set('connected', int(connected), device=device)
+    registry.set('active_profile', state['profile'], device=device)
+    registry.set('report_rate_hz', state.get('report_rate'), device=device)
+    registry.set('battery_percent', session.battery, device=device)
+    for preset, dpi in enumerate(state.get('dpi', [])):
+        registry.set('dpi', dpi, device=device, preset=preset)
+
+
+class MetricsExporter(object):
+    """
+    Exports the registry to a node_exporter textfile collector
+    and/or a local HTTP endpoint.
+    """
+    def __init__(self, textfile=None, port=None, address='127.0.0.1', interval=15):
+        self._textfile = textfile
+        self._port = port
+        self._address = address
+        self._interval = interval
+        self._written = None
+        self._sessions = {}
+
+    def add_session(self, session):
+        """
+        Start following the state of a session, must be called on the loop thread.
+        """
+        from .watch import DeviceWatcher
+
+        self._sessions[session.name] = session
+        # no polling, the battery charge is exported as read by others
+        watcher = DeviceWatcher(self._on_event, intervals={'battery': 0})
+        watcher.add_session(session)
+
+    def _on_event(self, event):
+        session = self._sessions.get(event['device'])
+        if session is not None:
+            update_device(session, connected=event['event'] != 'removed')
+
+    def start(self):
+        from gi.repository import GLib
+
+        GLib.timeout_add_seconds(self._interval, self._update_battery)
+        if self._textfile:
+            self._write_textfile()
+            GLib.timeout_add_seconds(self._interval, self._write_textfile)
+
+        if self._port:
+            server = http.server.ThreadingHTTPServer(
+                (self._address, self._port), MetricsHandler)
+            thread = threading.Thread(
+                target=server.serve_forever, name='metrics', daemon=True)
+            thread.start()
+            logger.debug('serving metrics on http://{}:{}/metrics'.format(
+                self._address, self._port))
+
+    def _update_battery(self):
+        # the last charge read, not a read of its own
+        for name, session in self._sessions.items():
+            registry.set('battery_percent', session.battery, device=name)
+        return True  # keep the timeout
+
+    def _write_textfile(self):
+        if self._written != registry.version:
+            self._written = registry.version
+            tmp = self._textfile + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    f.write(registry.render())
+                os.replace(tmp, self._textfile)
+            except OSError as e:
+                logger.warning('unable to write metrics: {}'.format(e))
+        return True  # keep the timeout
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('metrics: ' + format % args)
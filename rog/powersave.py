@@ -0,0 +1,292 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Battery-aware report rate.
+
+Lowers the report rate of a wireless mouse while it's idle or low on
+charge and restores the configured rate on sustained fast movement
+or while one of the listed games is running. Thresholds have hysteresis,
+a restored rate is held for a while and the number of rate changes
+per minute is limited.
+
+The rate is stored in the onboard profile, so the configured rate is
+remembered in the data directory (the one on the device may be the low
+rate left by a previous run) and written back on exit.
+"""
+
+import collections
+import json
+import os
+import time
+
+from gi.repository import GLib
+
+from . import logger
+from .accel import EV_REL, EV_SYN, EVENT, REL_X, REL_Y, SYN_REPORT
+from .utils import get_data_dir
+from .worker import BACKGROUND
+
+STATE_NAME = 'powersave.json'
+
+# configured rate assumed when the device is found at the low rate
+DEFAULT_RATE = 1000
+
+DEFAULTS = {
+    'rate': 0,  # configured rate, 0 - remembered from the device
+    'low_rate': 250,
+    'idle_seconds': 30,
+    'low_battery': 20,
+    'battery_hysteresis': 5,
+    'battery_interval': 60,  # seconds between battery reads
+    'fast_speed': 2000,  # counts per second
+    'fast_seconds': 0.5,
+    'hold_seconds': 30,  # min. time at the configured rate before lowering it
+    'max_switches': 4,  # per minute
+    'interval': 0.5,
+    'games': '',
+}
+
+
+class MotionCounter(object):
+    """
+    Event tap counting the total motion in counts.
+    """
+    def __init__(self):
+        self.motion = 0
+        self._dx = 0
+        self._dy = 0
+
+    def __call__(self, data):
+        dx = self._dx
+        dy = self._dy
+        for _, _, type, code, value in EVENT.iter_unpack(data):
+            if type == EV_REL and code == REL_X:
+                dx += value
+            elif type == EV_REL and code == REL_Y:
+                dy += value
+            elif type == EV_SYN and code == SYN_REPORT and (dx or dy):
+                self.motion += int((dx * dx + dy * dy) ** 0.5)
+                dx = dy = 0
+        self._dx = dx
+        self._dy = dy
+
+
+def find_processes(names):
+    """
+    Names from ``names`` of the running processes.
+    """
+    found = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/comm'.format(pid)) as f:
+                comm = f.read().strip()
+        except OSError:
+            continue
+        if comm in names:
+            found.add(comm)
+    return found
+
+
+def load_rates():
+    """
+    Remembered configured rates, device name -> rate.
+    """
+    try:
+        with open(os.path.join(get_data_dir(), STATE_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_rate(name, rate):
+    rates = load_rates()
+    if rates.get(name) == rate:
+        return
+    rates[name] = rate
+    path = os.path.join(get_data_dir(), STATE_NAME)
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(rates, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logger.warning('unable to save the report rate: {}'.format(e))
+
+
+class ReportRatePolicy(object):
+    """
+    Switches the report rate of a session between the configured
+    and the low rate. Must be used on the GLib main loop thread.
+    """
+    def __init__(self, session, motion, settings=None):
+        self._session = session
+        self._motion = motion
+        self._settings = dict(DEFAULTS, **(settings or {}))
+        self._games = set(self._settings['games'].split())
+
+        self._rate = self._load_rate()  # configured rate
+        self._applied = session.active_profile.report_rate  # last rate set
+        self._low_battery = False
+        self._switches = collections.deque()
+        self._pending = False
+
+        now = time.monotonic()
+        self._last_motion = motion.motion
+        self._last_tick = now
+        self._last_active = now
+        self._fast_since = None
+        self._raised = 0  # last time the configured rate was requested
+        self._games_checked = 0
+        self._game = None
+
+    @classmethod
+    def from_config(cls, session, motion, config):
+        settings = {}
+        if config.has_section('powersave'):
+            for name, default in DEFAULTS.items():
+                if config.has_option('powersave', name):
+                    settings[name] = type(default)(config.get('powersave', name))
+        return cls(session, motion, settings)
+
+    def _load_rate(self):
+        name = self._session.name
+        rate = self._settings['rate'] or load_rates().get(name)
+        if rate:
+            return rate
+
+        rate = self._session.active_profile.report_rate
+        if rate == self._settings['low_rate']:
+            # most likely left by a run which didn't exit cleanly
+            logger.info('{} is at the low rate, assuming {} Hz is configured'.format(
+                name, DEFAULT_RATE))
+            rate = DEFAULT_RATE
+        save_rate(name, rate)
+        return rate
+
+    def start(self):
+        self._switch(self._rate, 'configured rate')
+        GLib.timeout_add(int(self._settings['interval'] * 1000), self.tick)
+        self.read_battery()
+        GLib.timeout_add_seconds(self._settings['battery_interval'], self.read_battery)
+
+    def read_battery(self):
+        """
+        Queue a battery read on the device worker, behind the user's changes.
+        """
+        if self._session.removed:
+            return False  # remove the timeout
+        self._session.worker.submit(
+            self._session.read_battery, priority=BACKGROUND,
+            callback=self._on_battery, key='battery')
+        return True  # keep the timeout
+
+    def _on_battery(self, result, error):
+        if error is not None:
+            logger.debug('unable to read battery charge: {}'.format(error))
+
+    def tick(self):
+        if self._session.removed:
+            return False  # remove the timeout
+
+        s = self._settings
+        now = time.monotonic()
+
+        motion = self._motion.motion
+        speed = (motion - self._last_motion) / (now - self._last_tick)
+        self._last_motion = motion
+        self._last_tick = now
+
+        if speed > 0:
+            self._last_active = now
+        if speed >= s['fast_speed']:
+            if self._fast_since is None:
+                self._fast_since = now
+        else:
+            self._fast_since = None
+
+        if self._games and now - self._games_checked >= 5:
+            self._games_checked = now
+            found = find_processes(self._games)
+            self._game = min(found) if found else None
+
+        battery = self._session.battery
+        if battery is not None:
+            if battery <= s['low_battery']:
+                self._low_battery = True
+            elif battery >= s['low_battery'] + s['battery_hysteresis']:
+                self._low_battery = False
+
+        # the user changed the rate, take it as the configured one
+        current = self._session.active_profile.report_rate
+        if not self._pending and current != self._applied:
+            self._rate = self._applied = current
+            save_rate(self._session.name, current)
+
+        if self._game is not None:
+            self._raised = now
+            self._switch(self._rate, 'game {} is running'.format(self._game))
+        elif self._fast_since is not None and now - self._fast_since >= s['fast_seconds']:
+            self._raised = now
+            self._switch(self._rate, 'fast movement ({:.0f} counts/s)'.format(speed))
+        elif now - self._raised < s['hold_seconds']:
+            pass  # keep the restored rate, don't flap on every pause
+        elif self._low_battery:
+            self._switch(s['low_rate'], 'battery at {}%'.format(battery))
+        elif now - self._last_active >= s['idle_seconds']:
+            self._switch(s['low_rate'], 'idle for {:.0f} s'.format(now - self._last_active))
+
+        return True  # keep the timeout
+
+    def _switch(self, rate, reason):
+        if rate == self._applied:
+            return
+
+        now = time.monotonic()
+        while self._switches and now - self._switches[0] > 60:
+            self._switches.popleft()
+        if len(self._switches) >= self._settings['max_switches']:
+            logger.debug('report rate change to {} Hz postponed: limit reached'.format(rate))
+            return
+
+        self._switches.append(now)
+        logger.info('report rate {} -> {} Hz: {}'.format(self._applied, rate, reason))
+        self._applied = rate
+
+        self._pending = True
+        self._session.set_report_rate(rate)
+        self._session.commit_later(self._on_switched, priority=BACKGROUND)
+
+    def restore(self, timeout=5.0):
+        """
+        Write the configured rate back, e.g. on exit. Must be called on the
+        loop thread (or once it's stopped), blocks until it's written.
+        """
+        if self._applied == self._rate or self._session.removed:
+            return
+
+        logger.info('report rate {} -> {} Hz: exiting'.format(self._applied, self._rate))
+        self._session.set_report_rate(self._rate)
+        job = self._session.worker.submit(self._session.commit)
+        if not job.wait(timeout):
+            logger.warning('report rate not restored: the device didn\'t respond')
+
+    def _on_switched(self, result, error):
+        self._pending = False
+        if error is not None:
+            logger.warning('unable to change report rate: {}'.format(error))
+            self._applied = self._session.active_profile.report_rate
@@ -0,0 +1,316 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Recording and replaying of HID traffic.
+
+Capture file format (little endian):
+
+    b'RGDR', version (u8), metadata length (u16), metadata (JSON)
+    records: time since the previous record in us (u32),
+             device index (u8),
+             type (u8, 0 - to device, 1 - from device, 2 - device info),
+             length (u16), data
+
+A device info record (JSON: hidraw path, sysfs path of the physical device,
+bus, vid, pid, name and the report descriptor in hex) precedes the traffic
+of its hidraw node, the nodes are numbered in the order of these records.
+
+``attach()`` records the I/O of the ratbag drivers, every driver device
+(``Rodent``) talks to one hidraw node, so the traffic is tagged with
+the node even when one ratbag instance drives all interfaces of a mouse.
+The ``devices`` of ``HidReplay`` are attached to ratbag as emulators and
+answer the traffic sent by the driver with the recorded responses.
+"""
+
+import functools
+import json
+import os
+import struct
+import threading
+import time
+
+from . import logger
+from .devices import read_hid_info
+
+MAGIC = b'RGDR'
+VERSION = 2
+
+HEADER = struct.Struct('<4sBH')
+RECORD = struct.Struct('<IBBH')
+
+TX = 0  # host -> device
+RX = 1  # device -> host
+DEVICE = 2  # device info
+
+# HID I/O methods of the ratbag driver base class, the requests
+# of feature reads are recorded as the report ID
+DRIVER_IO = ('send', 'recv', 'hid_get_feature', 'hid_set_feature')
+
+_recorder = None
+
+
+def _record_io(func, name):
+    @functools.wraps(func)
+    def wrapper(rodent, *args, **kwargs):
+        recorder = _recorder
+        path = getattr(rodent, 'path', None)
+        if recorder is None or path is None:
+            return func(rodent, *args, **kwargs)
+
+        if name == 'hid_get_feature':
+            recorder.log_tx(path, bytes([args[0]]))
+        elif name != 'recv':
+            recorder.log_tx(path, args[-1])
+        result = func(rodent, *args, **kwargs)
+        if name in ('recv', 'hid_get_feature') and result is not None:
+            recorder.log_rx(path, result)
+        return result
+    return wrapper
+
+
+def attach(recorder):
+    """
+    Record the HID traffic of the ratbag drivers to ``recorder``,
+    must be called before ratbag is started.
+    """
+    global _recorder
+
+    if _recorder is None:
+        try:
+            from ratbag.driver import Rodent
+        except ImportError:
+            logger.warning('ratbag driver I/O not found, nothing is recorded')
+            return
+
+        for name in DRIVER_IO:
+            func = getattr(Rodent, name, None)
+            if func is not None:
+                setattr(Rodent, name, _record_io(func, name))
+    _recorder = recorder
+
+
+class HidRecorder(object):
+    """
+    Writes the HID reports sent to and received from the hidraw nodes.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+        self._last = None
+        self._indices = {}  # hidraw node -> device index
+        self._lock = threading.Lock()
+
+    def init(self, metadata=None):
+        """
+        Start a capture, ``metadata`` describes the capture as a whole.
+        """
+        metadata = json.dumps(metadata or {}, default=str).encode()
+        self._file = open(self._path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, len(metadata)))
+        self._file.write(metadata)
+        self._last = time.monotonic()
+
+    def add_device(self, info):
+        """
+        Start recording a hidraw node, ``info`` is its identity
+        (see ``devices.read_hid_info()``). Returns its index.
+        """
+        path = os.path.realpath(info['path'])
+        with self._lock:
+            if self._file is None:
+                self.init()
+            if path in self._indices:
+                return self._indices[path]
+            index = self._indices[path] = len(self._indices)
+        self._log(index, DEVICE, json.dumps(info).encode())
+        return index
+
+    def log_tx(self, path, data):
+        self._log(self._get_index(path), TX, data)
+
+    def log_rx(self, path, data):
+        self._log(self._get_index(path), RX, data)
+
+    def _get_index(self, path):
+        index = self._indices.get(os.path.realpath(path))
+        if index is None:  # not announced by the bridge
+            index = self.add_device(read_hid_info(path))
+        return index
+
+    def _log(self, index, type, data):
+        if self._file is None:
+            return
+
+        data = bytes(data)
+        with self._lock:
+            now = time.monotonic()
+            delta = min(int((now - self._last) * 1000000), 0xFFFFFFFF)
+            self._last = now
+            self._file.write(RECORD.pack(delta, index, type, len(data)))
+            self._file.write(data)
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_capture(path):
+    """
+    Metadata, ``[device info]`` and ``[(delay in seconds, device index,
+    direction, data)]`` of a capture.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError('{} is not a rogdrv capture'.format(path))
+        magic, version, length = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('{} is not a rogdrv capture'.format(path))
+        if version != VERSION:
+            raise ValueError('{}: unsupported capture version {}'.format(path, version))
+        metadata = json.loads(f.read(length))
+
+        devices = []
+        records = []
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            delta, index, type, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                logger.warning('{}: truncated capture'.format(path))
+                break
+            if type == DEVICE:
+                devices.append(json.loads(data))
+            else:
+                records.append((delta / 1000000, index, type, data))
+
+    return metadata, devices, records
+
+
+class HidReplay(object):
+    """
+    Serves a capture in place of the real devices, one ``ReplayDevice``
+    per recorded device in ``devices``.
+
+    With ``realtime`` the recorded delays of the responses are kept, which
+    blocks the thread running ratbag, otherwise the responses are returned
+    immediately.
+    """
+    def __init__(self, path, realtime=False):
+        self.name = os.path.basename(path)
+        self.metadata, infos, records = read_capture(path)
+        self.devices = [ReplayDevice(info) for info in infos]
+        self.realtime = realtime
+
+        # delays between the records of each device
+        now = 0.0
+        last = [0.0] * len(self.devices)
+        for delta, index, direction, data in records:
+            now += delta
+            if index >= len(self.devices):
+                raise ValueError('{}: record of unknown device {}'.format(path, index))
+            self.devices[index].records.append((now - last[index], direction, data))
+            last[index] = now
+
+    @property
+    def realtime(self):
+        return self._realtime
+
+    @realtime.setter
+    def realtime(self, value):
+        self._realtime = value
+        for device in self.devices:
+            device.realtime = value
+
+    def groups(self):
+        """
+        The ``devices`` grouped by their physical device,
+        each group is served by one ratbag instance as recorded.
+        """
+        groups = {}
+        for device in self.devices:
+            groups.setdefault(device.info.get('device', device.path), []).append(device)
+        return list(groups.values())
+
+    @property
+    def mismatches(self):
+        return sum(device.mismatches for device in self.devices)
+
+    @property
+    def finished(self):
+        return all(device.finished for device in self.devices)
+
+
+class ReplayDevice(object):
+    """
+    Recorded device attached to ratbag as an emulator.
+
+    Every report sent by the driver is compared with the next recorded one
+    and answered with the responses recorded after it.
+    """
+    def __init__(self, info):
+        self.info = info
+        self.path = info.get('path')
+        self.name = info.get('name')
+        self.bus = info.get('bus')
+        self.vid = info.get('vid')
+        self.pid = info.get('pid')
+        self.report_descriptor = bytes.fromhex(info.get('report_descriptor', ''))
+        self.records = []
+        self.realtime = False
+        self._position = 0
+        self.mismatches = 0
+
+    def log_tx(self, data):
+        """
+        Report sent by the driver, returns the recorded responses.
+        """
+        data = bytes(data)
+        records = self.records
+
+        # skip unsolicited device events recorded before this report
+        while self._position < len(records) and records[self._position][1] != TX:
+            self._position += 1
+
+        if self._position >= len(records):
+            logger.debug('replay {}: capture exhausted'.format(self.name))
+            self.mismatches += 1
+            return []
+
+        _, _, expected = records[self._position]
+        self._position += 1
+        if expected != data:
+            logger.debug('replay {}: expected {}, got {}'.format(
+                self.name, expected.hex(), data.hex()))
+            self.mismatches += 1
+
+        responses = []
+        while self._position < len(records) and records[self._position][1] == RX:
+            delay, _, response = records[self._position]
+            self._position += 1
+            if self.realtime:
+                time.sleep(delay)
+            responses.append(response)
+        return responses
+
+    @property
+    def finished(self):
+        return self._position >= len(self.records)
@@ -0,0 +1,97 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+udev rules generator.
+
+    python3 -m rog.udev [-o /etc/udev/rules.d/50-rogdrv.rules]
+
+Events of other vendors leave the rules after a single vendor check,
+so udev doesn't match every product ID against every USB/hidraw event.
+"""
+
+import argparse
+import re
+import sys
+
+from .devices import DEVICES, VENDOR_ID
+
+ID_RE = re.compile(r'^[0-9a-f]{4}$')
+
+PERMISSIONS = 'MODE="0660", GROUP="plugdev", TAG+="uaccess", TAG+="udev-acl"'
+
+
+def validate_id(value):
+    if not ID_RE.match(value):
+        raise ValueError(
+            'Invalid USB ID "{}", 4 lowercase hex digits expected'.format(value))
+    return value
+
+
+def generate_rules(devices=DEVICES, vendor_id=VENDOR_ID):
+    validate_id(vendor_id)
+
+    lines = [
+        '# Generated by rogdrv, do not edit: python3 -m rog.udev',
+        '',
+        '# uinput',
+        'KERNEL=="uinput*", GROUP="plugdev", MODE="0660"',
+        '',
+        'ACTION=="remove", GOTO="rogdrv_end"',
+        'SUBSYSTEM!="usb|hidraw", GOTO="rogdrv_end"',
+        f'SUBSYSTEM=="usb", ATTR{{idVendor}}=="{vendor_id}", GOTO="rogdrv_vendor"',
+        f'SUBSYSTEM=="hidraw", ATTRS{{idVendor}}=="{vendor_id}", GOTO="rogdrv_vendor"',
+        'GOTO="rogdrv_end"',
+        '',
+        'LABEL="rogdrv_vendor"',
+    ]
+
+    seen = set()
+    for name, product_ids in devices:
+        for product_id in product_ids:
+            validate_id(product_id)
+            if product_id in seen:
+                raise ValueError('Duplicate product ID "{}"'.format(product_id))
+            seen.add(product_id)
+
+        lines.append('')
+        lines.append(f'# {name}')
+        lines.append(
+            f'ATTRS{{idVendor}}=="{vendor_id}", '
+            f'ATTRS{{idProduct}}=="{"|".join(product_ids)}", {PERMISSIONS}')
+
+    lines.append('')
+    lines.append('LABEL="rogdrv_end"')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-o', '--output', type=str, required=False, default=None,
+        help='Rules file to write, stdout by default')
+    args = parser.parse_args()
+
+    rules = generate_rules()
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(rules)
+    else:
+        sys.stdout.write(rules)
+
+
+if __name__ == '__main__':
+    main()
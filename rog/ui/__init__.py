@@ -14,34 +14,37 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+import atexit
 import gi
-import os
 import signal
 
 gi.require_version('Gtk', '3.0')
-gi.require_version('Notify', '0.7')
 
-from gi.repository import Gtk
-from gi.repository import Notify
-
-import ratbag
+from gi.repository import GLib, Gtk
 
+from .. import logger
+from ..api import RatbagBridge
+from ..utils import load_config
 from .menu import TrayMenu
 from .handler import TrayMenuEventHandler
-from .utils import find_icons, get_autostart_path
+from .utils import APPID, find_icons, get_ui_path
+
 
-APPID = 'rogdrv'
+def on_quit_signal():
+    logger.debug('quit signal received')
+    Gtk.main_quit()
+    return False  # remove the signal source
 
 
-def gtk3_main():
-    # Handle pressing Ctr+C properly, ignored by default
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
+def gtk3_main(args):
+    # Quit the main loop on Ctrl+C (ignored by default) and on SIGTERM,
+    # so the exit handlers (e.g. the analytics snapshot) still run
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, on_quit_signal)
 
-    # generate UI
+    # generate UI, submenus are built by the handler when opened
     builder = Gtk.Builder()
-    builder.add_from_file(os.path.join(
-        os.path.abspath(os.path.dirname(__file__)),
-        'gtk3.glade'))
+    builder.add_objects_from_file(get_ui_path(), ['menu'])
 
     def f(r, device):
         print(device)
@@ -54,11 +57,96 @@ def gtk3_main():
     # bind events
     handler = TrayMenuEventHandler(builder)
     builder.connect_signals(handler)
-    ratbagd = ratbag.Ratbag.create()
-    ratbagd.connect('device-added', handler.on_device_added)
-    ratbagd.start()
+    bridge = RatbagBridge(thread=False)
+    bridge.connect(handler.on_device_added)
+
+    if args.metrics_textfile or args.metrics_port:
+        from ..metrics import MetricsExporter
+        exporter = MetricsExporter(args.metrics_textfile, args.metrics_port)
+        bridge.connect(exporter.add_session)
+        exporter.start()
+
+    # threads reading the evdev node of each mouse for the input taps
+    readers = {}  # session -> AccelThread, EventReader or None
+
+    def get_events(session):
+        if session not in readers:
+            from ..accel import AccelCurve, AccelThread, EventReader, find_event_node
+
+            events = None
+            device = find_event_node(session.nodes)
+            if device is None:
+                logger.warning('no input device found for {}'.format(session.name))
+            elif args.accel:
+                events = AccelThread(device, AccelCurve.from_config(load_config()))
+            else:
+                events = EventReader(device)
+            if events is not None:
+                events.start()  # ends by itself once the device is gone
+            readers[session] = events
+            session.connect_removed(readers.pop)
+        return readers[session]
+
+    if args.accel:
+        bridge.connect(get_events)
+
+    if args.powersave:
+        from ..powersave import MotionCounter, ReportRatePolicy
+
+        def start_powersave(session):
+            if not session.has_battery:
+                logger.info('{} is not wireless, report rate is not managed'.format(session.name))
+                return
+
+            events = get_events(session)
+            if events is not None:
+                motion = MotionCounter()
+                events.taps.append(motion)
+                policy = ReportRatePolicy.from_config(session, motion, load_config())
+                policy.start()
+                atexit.register(policy.restore)
+
+        bridge.connect(start_powersave)
+
+    if args.analytics:
+        from ..analytics import UsageCollector
+
+        def start_analytics(session):
+            events = get_events(session)
+            if events is not None:
+                collector = UsageCollector(session)
+                events.taps.append(collector.feed)
+                collector.start()
+                session.connect_removed(lambda session: collector.stop())
+                atexit.register(collector.snapshot)
+
+        bridge.connect(start_analytics)
+
+    # control socket for DPI switches from rogdrv-config, scripts and shortcuts
+    from ..control import ControlServer, DpiKeyTap
+
+    control = ControlServer()
+    bridge.connect(control.add_session)
+    control.connect(handler.on_dpi_switched)
+    try:
+        control.start()
+        atexit.register(control.stop)
+    except OSError as e:
+        logger.warning('unable to start the control socket: {}'.format(e))
+
+    config = load_config()
+    if config.has_section('dpi'):
+        dpi_keys = DpiKeyTap.from_config(control, config)
+
+        def start_dpi_keys(session):
+            events = get_events(session) if dpi_keys.keys else None
+            if events is not None and dpi_keys not in events.taps:
+                events.taps.append(dpi_keys)
+
+        bridge.connect(start_dpi_keys)
+
+    bridge.start()
 
     # create tray icon
     trayicon = TrayMenu(APPID, next(find_icons()), builder.get_object('menu'))
-    Notify.init(APPID)
     Gtk.main()
@@ -16,8 +16,10 @@
 
 import os
 
-from . import Gtk, Notify
-from .utils import get_autostart_path
+from gi.repository import GLib
+
+from . import Gtk
+from .utils import get_autostart_path, get_ui_path, notify, notify_uninit
 from .. import logger
 
 
@@ -27,65 +29,153 @@ class TrayMenuEventHandler(object):
     """
     def __init__(self, builder):
         self._builder = builder
+        self._submenus = {}  # name -> builder of the opened submenus
+        self._closing = set()  # names of the submenus waiting for release
+        self._session = None
         self._device = None
 
-        menu_profile = self._builder.get_object('menu_profile')
+        menu_profile = self._get_object('menu_profile')
         menu_profile.set_visible(False)
 
-        menu_dpi = self._builder.get_object('menu_dpi')
+        menu_dpi = self._get_object('menu_dpi')
         menu_dpi.set_visible(False)
 
-        menu_led = self._builder.get_object('menu_led')
+        menu_led = self._get_object('menu_led')
         menu_led.set_visible(False)
 
-        menu_rate = self._builder.get_object('menu_rate')
+        menu_rate = self._get_object('menu_rate')
         menu_rate.set_visible(False)
 
-        menu_perf = self._builder.get_object('menu_perf')
+        menu_perf = self._get_object('menu_perf')
         menu_perf.set_visible(False)
 
-        autostart = self._builder.get_object('menu_autostart')
+        autostart = self._get_object('menu_autostart')
         autostart.set_active(os.path.exists(get_autostart_path()))
 
-    def on_device_added(self, r, device):
-        self._device = device
+    def _get_object(self, name):
+        for builder in self._submenus.values():
+            obj = builder.get_object(name)
+            if obj is not None:
+                return obj
+        return self._builder.get_object(name)
+
+    def _apply(self, func, *args, **kwargs):
+        """
+        Apply a change and commit it on the device I/O worker.
+        """
+        func(*args, **kwargs)
+        self._session.commit_later(self._on_applied)
+
+    def _on_applied(self, result, error):
+        if error is not None:
+            logger.error('unable to save settings: {}'.format(error))
+            notify('Unable to save settings', str(error))
 
-        for i in range(6):
-            if i >= len(device.profiles):
-                menu_item = self._builder.get_object('menu_profile_{}'.format(i))
-                menu_item.set_visible(False)
-        menu_profile = self._builder.get_object('menu_profile')
+    def on_device_added(self, session):
+        self._session = session
+        self._device = device = session.device
+        session.connect_removed(self.on_device_removed)
+
+        menu_profile = self._get_object('menu_profile')
         menu_profile.set_visible(bool(device.profiles))
 
         for profile in device.profiles:
             if not profile.active:
                 continue
 
-            for i in range(4):
-                menu_item = self._builder.get_object('menu_dpi_{}'.format(i))
-                if i >= len(profile.resolutions):
-                    menu_item.set_visible(False)
-            menu_dpi = self._builder.get_object('menu_dpi')
+            menu_dpi = self._get_object('menu_dpi')
             menu_dpi.set_visible(True)
+            if session.dpi_presets:
+                self.on_dpi_switched(
+                    session, session.dpi_preset,
+                    session.dpi_presets[session.dpi_preset])
 
             # if not self._device.wireless:
             if True:
-                self._builder.get_object('menu_sleep').set_visible(False)
-                self._builder.get_object('menu_battery').set_visible(False)
-
-            if profile.leds:
-                for i in range(3):
-                    if i >= len(profile.leds):
-                        menu_item = self._builder.get_object('menu_led_{}'.format(i))
-                        menu_item.set_visible(False)
-            menu_led = self._builder.get_object('menu_led')
+                self._get_object('menu_sleep').set_visible(False)
+                self._get_object('menu_battery').set_visible(False)
+
+            menu_led = self._get_object('menu_led')
             menu_led.set_visible(bool(profile.leds))
 
-            menu_rate = self._builder.get_object('menu_rate')
+            menu_rate = self._get_object('menu_rate')
             menu_rate.set_visible(True)
 
+    def on_device_removed(self, session):
+        if session is not self._session:
+            return
+
+        self._session = None
+        self._device = None
+        for name in ('menu_profile', 'menu_dpi', 'menu_led', 'menu_rate'):
+            self._get_object(name).set_visible(False)
+
+    def on_submenu_open(self, item, *args, **kwargs):
+        """
+        Event on top level submenu expanding, builds the submenu items.
+        """
+        name = Gtk.Buildable.get_name(item)
+        self._closing.discard(name)
+        if name in self._submenus:
+            return
+
+        logger.debug('building submenu {}'.format(name))
+        builder = Gtk.Builder()
+        builder.add_objects_from_file(get_ui_path(), ['{}_items'.format(name)])
+        builder.connect_signals(self)
+
+        items = builder.get_object('{}_items'.format(name))
+        submenu = self._builder.get_object('{}_submenu'.format(name))
+        for child in items.get_children():
+            items.remove(child)
+            submenu.append(child)
+        items.destroy()
+        self._submenus[name] = builder
+
+        if self._session is None:
+            return
+
+        # hide the items unsupported by the device
+        profile = self._session.active_profile
+        if name == 'menu_profile':
+            for i in range(6):
+                if i >= len(self._device.profiles):
+                    menu_item = self._get_object('menu_profile_{}'.format(i))
+                    menu_item.set_visible(False)
+        elif name == 'menu_dpi' and profile is not None:
+            for i in range(4):
+                if i >= len(profile.resolutions):
+                    menu_item = self._get_object('menu_dpi_{}'.format(i))
+                    menu_item.set_visible(False)
+        elif name == 'menu_led' and profile is not None:
+            for i in range(3):
+                if i >= len(profile.leds):
+                    menu_item = self._get_object('menu_led_{}'.format(i))
+                    menu_item.set_visible(False)
+
+    def on_submenu_close(self, submenu, *args, **kwargs):
+        """
+        Event on top level submenu closing, releases the submenu items.
+
+        GTK emits "deactivate" before it activates the clicked item,
+        so the items are released later from the main loop.
+        """
+        name = Gtk.Buildable.get_name(submenu)[:-len('_submenu')]
+        if name in self._submenus:
+            self._closing.add(name)
+            GLib.idle_add(self._release_submenu, submenu, name)
+
+    def _release_submenu(self, submenu, name):
+        if name in self._closing:  # not opened again in the meantime
+            self._closing.discard(name)
+            del self._submenus[name]
+            logger.debug('releasing submenu {}'.format(name))
+            for child in submenu.get_children():
+                child.destroy()
+        return False  # don't repeat the idle callback
+
     def on_quit(self, *args, **kwargs):
-        Notify.uninit()
+        notify_uninit()
         Gtk.main_quit()
 
     def on_autostart(self, item, *args, **kwargs):
@@ -115,7 +205,7 @@ StartupNotify=false
         Event on profile submenu expanding.
         """
         for profile in self._device.profiles:
-            menu_item = self._builder.get_object('menu_profile_{}'.format(profile.index))
+            menu_item = self._get_object('menu_profile_{}'.format(profile.index))
             if profile.active:
                 logger.debug('current profile is {}'.format(profile.index))
                 menu_item.set_active(True)
@@ -136,23 +226,47 @@ StartupNotify=false
                 logger.debug(
                     'switching profile from {} to {}'
                     .format(profile_old, profile_new))
-                for profile in self._device.profiles:
-                    if profile.index == profile_new:
-                        profile.set_active()
+                self._session.worker.submit(
+                    self._session.set_profile, profile_new,
+                    callback=self._on_profile_switched)
+
+    def _on_profile_switched(self, result, error):
+        self._on_applied(result, error)
+
+        # the DPI presets are the ones of the new profile
+        session = self._session
+        if session is not None and session.dpi_presets:
+            self.on_dpi_switched(
+                session, session.dpi_preset, session.dpi_presets[session.dpi_preset])
 
     def on_dpi_choice(self, item, *args, **kwargs):
         """
         Event on DPI submenu expanding.
         """
-        for profile in self._device.profiles:
-            if not profile.active:
-                continue
+        active = self._session.dpi_preset
+        for index, dpi in enumerate(self._session.dpi_presets):
+            menu_item = self._get_object('menu_dpi_{}'.format(index))
+            menu_item.set_label(
+                'Preset {}: {}{}'
+                .format(index, dpi, ' (active)' if index == active else ''))
+
+    def on_dpi(self, item, *args, **kwargs):
+        """
+        Event on DPI preset select.
+        """
+        preset = int(str(item.get_action_target_value()))  # GVariant -> str -> int
+        if preset != self._session.dpi_preset:
+            preset, dpi = self._session.switch_dpi_preset(
+                preset, callback=self._on_applied)
+            self.on_dpi_switched(self._session, preset, dpi)
 
-            for resolution in profile.resolutions:
-                menu_item = self._builder.get_object('menu_dpi_{}'.format(resolution.index))
-                menu_item.set_label(
-                    'Preset {}: {}'
-                    .format(resolution.index, resolution.dpi[0]))
+    def on_dpi_switched(self, session, preset, dpi):
+        """
+        Event on DPI preset switch, the labels are taken from the preset table.
+        """
+        self._get_object('menu_dpi').set_label('DPI: {}'.format(dpi))
+        if 'menu_dpi' in self._submenus:
+            self.on_dpi_choice(None)
 
     def on_rate_choice(self, item, *args, **kwargs):
         """
@@ -164,7 +278,7 @@ StartupNotify=false
 
             logger.debug('current polling rate is {}'.format(profile.report_rate))
             for irate in profile.report_rates:
-                menu_item = self._builder.get_object('menu_rate_{}'.format(irate))
+                menu_item = self._get_object('menu_rate_{}'.format(irate))
                 if irate == profile.report_rate:
                     menu_item.set_active(True)
 
@@ -173,19 +287,14 @@ StartupNotify=false
         Event on polling rate select.
         """
         if item.get_active():
-            for profile in self._device.profiles:
-                if not profile.active:
-                    continue
+            rate_old = self._session.active_profile.report_rate
+            rate_new = int(str(item.get_action_target_value()))  # GVariant -> str -> int
 
-                rate_old = profile.report_rate
-                rate_new = int(str(item.get_action_target_value()))  # GVariant -> str -> int
-
-                if rate_old != rate_new:
-                    logger.debug(
-                        'changing polling rate from {} to {}'
-                        .format(rate_old, rate_new))
-                    profile.set_report_rate(rate_new)
-                    self._device.emit('commit', None)
+            if rate_old != rate_new:
+                logger.debug(
+                    'changing polling rate from {} to {}'
+                    .format(rate_old, rate_new))
+                self._apply(self._session.set_report_rate, rate_new)
 
     def on_perf_choice(self, item, *args, **kwargs):
         """
@@ -195,7 +304,7 @@ StartupNotify=false
         logger.debug(
             'angle snapping is {}'
             .format('enabled' if snapping else 'disabled'))
-        menu_item = self._builder.get_object('menu_snapping')
+        menu_item = self._get_object('menu_snapping')
         menu_item.set_active(snapping)
 
     def on_snapping(self, item, *args, **kwargs):
@@ -221,7 +330,7 @@ StartupNotify=false
         sleep, _, _ = self._device.get_sleep_charge_alert()
         logger.debug('current sleep timeout is {}'.format(sleep))
         for isleep in defs.SLEEP_TIME.values():
-            menu_item = self._builder.get_object('menu_sleep_{}'.format(isleep))
+            menu_item = self._get_object('menu_sleep_{}'.format(isleep))
             if isleep == sleep:
                 menu_item.set_active(True)
 
@@ -246,11 +355,11 @@ StartupNotify=false
         _, charge, alert = self._device.get_sleep_charge_alert()
         logger.debug('current battery alert level is {}%'.format(alert))
         for ialert in (0, 25, 50):
-            menu_item = self._builder.get_object('menu_alert_{}'.format(ialert))
+            menu_item = self._get_object('menu_alert_{}'.format(ialert))
             if ialert == alert:
                 menu_item.set_active(True)
 
-        self._builder.get_object('menu_charge').set_label('Charge: {}%'.format(charge))
+        self._get_object('menu_charge').set_label('Charge: {}%'.format(charge))
 
     def on_alert(self, item, *args, **kwargs):
         """
@@ -275,13 +384,13 @@ StartupNotify=false
 
             for led in profile.leds:
                 if iled == led.index:
-                    c = self._builder.get_object('menu_led_{}_color'.format(led.index))
+                    c = self._get_object('menu_led_{}_color'.format(led.index))
                     c.set_label('Color: #{:02x}{:02x}{:02x}'.format(*led.color))
 
-                    b = self._builder.get_object('menu_led_{}_brightness'.format(led.index))
+                    b = self._get_object('menu_led_{}_brightness'.format(led.index))
                     b.set_label('Brightness: {}%'.format(round(led.brightness / 255 * 100)))
 
-                    m = self._builder.get_object('menu_led_{}_mode'.format(led.index))
+                    m = self._get_object('menu_led_{}_mode'.format(led.index))
                     m.set_label('Mode: {}'.format(led.mode.name))
 
     def on_led_mode_choice(self, item, *args, **kwargs):
@@ -293,7 +402,7 @@ StartupNotify=false
 
             for led in profile.leds:
                 if iled == led.index:
-                    menu_item = self._builder.get_object(
+                    menu_item = self._get_object(
                         'menu_led_{}_mode_{}'.format(led.index, led.mode.name.lower()))
                     menu_item.set_active(True)
 
@@ -318,8 +427,9 @@ StartupNotify=false
                                 break
 
                         if led_mode_old != led_mode_new:
-                            led.set_mode(led_mode_new)
-                            self._device.emit('commit', None)
+                            self._apply(
+                                self._session.set_leds,
+                                mode=led_mode_new, index=led.index)
 
     def on_led_brightness_choice(self, item, *args, **kwargs):
         led_id = int(str(item.get_action_target_value()))  # GVariant -> str -> int
@@ -330,7 +440,7 @@ StartupNotify=false
 
             for led in profile.leds:
                 if led_id == led.index:
-                    menu_item = self._builder.get_object(
+                    menu_item = self._get_object(
                         'menu_led_{}_brightness_{}'
                         .format(led.index, round(led.brightness / 255 * 100)))
                     menu_item.set_active(True)
@@ -352,5 +462,6 @@ StartupNotify=false
                         brightness_new = round(brightness / 100 * 255)
 
                         if brightness_old != brightness_new:
-                            led.set_brightness(brightness_new)
-                            self._device.emit('commit', None)
+                            self._apply(
+                                self._session.set_leds,
+                                brightness=brightness_new, index=led.index)
@@ -19,6 +19,10 @@ import os
 
 from gi.repository import Gtk
 
+APPID = 'rogdrv'
+
+_notify = None
+
 
 def get_autostart_path():
     xdg_home = os.environ.get('XDG_CONFIG_HOME')
@@ -30,6 +34,30 @@ def get_autostart_path():
     return os.path.join(home, '.config', 'autostart', 'rogdrv.desktop')
 
 
+def get_ui_path():
+    return os.path.join(os.path.abspath(os.path.dirname(__file__)), 'gtk3.glade')
+
+
+def notify(summary, body=None):
+    """
+    Show a desktop notification, libnotify is loaded on the first call.
+    """
+    global _notify
+
+    if _notify is None:
+        gi.require_version('Notify', '0.7')
+        from gi.repository import Notify
+        Notify.init(APPID)
+        _notify = Notify
+
+    _notify.Notification.new(summary, body, 'input-mouse').show()
+
+
+def notify_uninit():
+    if _notify is not None:
+        _notify.uninit()
+
+
 def find_icons():
     for location in (
             os.path.abspath(os.path.dirname(__file__)),
@@ -0,0 +1,67 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import configparser
+import os
+
+
+def get_config_dir():
+    """
+    rogdrv configuration directory, created if missing.
+    """
+    home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(
+        os.path.expanduser('~'), '.config')
+    path = os.path.join(home, 'rogdrv')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_cache_dir():
+    """
+    rogdrv cache directory, created if missing.
+    """
+    home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    path = os.path.join(home, 'rogdrv')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_data_dir():
+    """
+    rogdrv data directory, created if missing.
+    """
+    home = os.environ.get('XDG_DATA_HOME') or os.path.join(
+        os.path.expanduser('~'), '.local', 'share')
+    path = os.path.join(home, 'rogdrv')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_runtime_dir():
+    """
+    Directory for sockets, the cache directory if there's no user runtime directory.
+    """
+    return os.environ.get('XDG_RUNTIME_DIR') or get_cache_dir()
+
+
+def load_config():
+    """
+    Settings from ~/.config/rogdrv/rogdrv.conf (INI format).
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(get_config_dir(), 'rogdrv.conf'))
+    return config
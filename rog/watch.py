@@ -0,0 +1,165 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import enum
+import json
+import time
+
+from gi.repository import GLib
+
+from . import logger
+from .worker import BACKGROUND
+
+# values which the device doesn't report by itself, read on the device
+# worker, name -> (blocking read, default poll interval in seconds)
+POLLERS = {
+    'battery': (lambda session: session.read_battery(), 60),
+}
+
+
+def to_json_value(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, (tuple, list)):
+        return [to_json_value(v) for v in value]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class DeviceWatcher(object):
+    """
+    Reports device changes to ``emit(event)``.
+
+    Changes of ratbag objects are received from their GObject "notify"
+    signals, only the values listed in ``POLLERS`` are polled
+    (values which the device doesn't have, read as None, are not reported).
+    Must be used on the ratbag loop thread, changes done on the device
+    worker are reported from the loop thread as well.
+    """
+    def __init__(self, emit, intervals=None):
+        self._emit = emit
+        self._intervals = {
+            name: interval for name, (_, interval) in POLLERS.items()}
+        self._intervals.update(intervals or {})
+        self._polled = {}
+        self._handlers = []  # (object, handler id)
+        self._sources = []
+        self._stopped = False
+
+    def add_session(self, session):
+        if self._stopped:
+            return
+
+        self._send(session, 'added', state=session.state())
+
+        objects = [('device', session.device)]
+        for profile in session.profiles:
+            objects.append(('profile', profile))
+            for kind in ('resolutions', 'buttons', 'leds'):
+                for obj in getattr(profile, kind):
+                    objects.append((kind[:-1], obj))
+
+        for kind, obj in objects:
+            self._handlers.append(
+                (obj, obj.connect('notify', self._on_notify, session, kind)))
+
+        session.connect_removed(self._on_removed)
+
+        for name, interval in self._intervals.items():
+            if interval <= 0 or name not in POLLERS:
+                continue
+
+            self._poll(session, name)
+            self._sources.append(
+                GLib.timeout_add(int(interval * 1000), self._poll, session, name))
+
+    def stop(self):
+        """
+        Stop reporting, the devices stay open.
+        """
+        self._stopped = True
+        for obj, handler in self._handlers:
+            obj.disconnect(handler)
+        for source in self._sources:
+            GLib.source_remove(source)
+        self._handlers.clear()
+        self._sources.clear()
+
+    def _send(self, session, event, **kwargs):
+        self._emit(dict(time=time.time(), device=session.name, event=event, **kwargs))
+
+    def _on_notify(self, obj, pspec, session, kind):
+        value = obj.get_property(pspec.name)
+        if not session.is_loop_thread():
+            # changed by a commit on the device worker
+            GLib.idle_add(self._notify, obj, pspec.name, value, session, kind)
+        else:
+            self._notify(obj, pspec.name, value, session, kind)
+
+    def _notify(self, obj, name, value, session, kind):
+        if kind == 'profile' and name == 'active':
+            if value:
+                self._send(session, 'profile', value=obj.index)
+        else:
+            self._send(
+                session, 'changed', object=kind,
+                index=getattr(obj, 'index', None),
+                property=name, value=to_json_value(value))
+        return False  # don't repeat the idle callback
+
+    def _on_removed(self, session):
+        if not self._stopped:
+            self._send(session, 'removed')
+
+    def _poll(self, session, name):
+        if session.removed:
+            return False  # remove the timeout
+        read, _ = POLLERS[name]
+        session.worker.submit(
+            read, session, priority=BACKGROUND,
+            callback=lambda value, error: self._on_polled(session, name, value, error),
+            key='poll-{}'.format(name))
+        return True  # keep the timeout
+
+    def _on_polled(self, session, name, value, error):
+        if self._stopped:
+            return
+        if error is not None:
+            logger.debug('unable to read {}: {}'.format(name, error))
+            return
+        if value is None:
+            return
+
+        value = to_json_value(value)
+        key = (id(session), name)
+        if key not in self._polled or self._polled[key] != value:
+            self._polled[key] = value
+            self._send(session, name, value=value)
+
+
+def print_json(event):
+    print(json.dumps(event), flush=True)
+
+
+def print_text(event):
+    event = dict(event)
+    timestamp = time.strftime('%H:%M:%S', time.localtime(event.pop('time')))
+    device = event.pop('device')
+    name = event.pop('event')
+    print('[{}] {}: {} {}'.format(
+        timestamp, device, name,
+        ' '.join('{}={}'.format(k, v) for k, v in event.items())), flush=True)
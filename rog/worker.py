@@ -0,0 +1,153 @@
+# Copyright (C) 2023 Kyoken, kyoken@kyoken.ninja
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+"""
+Per-device HID I/O worker.
+
+All blocking device operations of a device go through a single worker
+thread with a priority queue, so interactive changes are never stuck
+behind background reads and the GTK thread never waits on hidraw.
+"""
+
+import itertools
+import queue
+import threading
+import time
+
+from gi.repository import GLib
+
+from . import logger
+
+# job priorities, lower runs first
+INTERACTIVE = 0
+BACKGROUND = 10
+
+# min. seconds between two jobs of a device
+MIN_INTERVAL = 0.05
+
+
+def deliver_idle(callback, *args):
+    """
+    Call ``callback(*args)`` from the default GLib main loop.
+    """
+    def run():
+        callback(*args)
+        return False  # don't repeat the idle callback
+
+    GLib.idle_add(run)
+
+
+class Job(object):
+    def __init__(self, func, args, kwargs, callback, key):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.key = key
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def cancel(self):
+        """
+        Drop the job if it didn't start yet.
+        """
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        """
+        Block until the job is finished or dropped,
+        for when the callbacks are no longer delivered (e.g. at exit).
+        """
+        return self.done.wait(timeout)
+
+
+class DeviceWorker(object):
+    """
+    Runs device jobs one by one on a dedicated thread.
+
+    ``callback(result, error)`` of a job is passed to ``deliver``,
+    by default it's called from the GLib main loop.
+    """
+    def __init__(self, name, min_interval=MIN_INTERVAL, deliver=deliver_idle):
+        self._name = name
+        self._min_interval = min_interval
+        self._deliver = deliver
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._keys = {}  # key -> last queued job
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name='worker {}'.format(name), daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, priority=INTERACTIVE, callback=None, key=None, **kwargs):
+        """
+        Queue ``func(*args, **kwargs)``.
+
+        A queued job with the same ``key`` is cancelled, so only the latest
+        request of e.g. a periodic read is executed.
+        """
+        job = Job(func, args, kwargs, callback, key)
+        with self._lock:
+            if key is not None:
+                stale = self._keys.get(key)
+                if stale is not None:
+                    stale.cancel()
+                self._keys[key] = job
+        self._queue.put((priority, next(self._counter), job))
+        return job
+
+    def stop(self, wait=True):
+        """
+        Stop the thread once the running job is finished,
+        the queued jobs are dropped.
+        """
+        self._queue.put((-1, next(self._counter), None))
+        if wait:
+            self._thread.join()
+
+    def _run(self):
+        last = 0.0
+        while True:
+            priority, _, job = self._queue.get()
+            if job is None:
+                break
+
+            with self._lock:
+                if job.key is not None and self._keys.get(job.key) is job:
+                    del self._keys[job.key]
+            if job.cancelled:
+                logger.debug('{}: skipping cancelled job {}'.format(self._name, job.func))
+                job.done.set()
+                continue
+
+            delay = last + self._min_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            result = error = None
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                logger.debug('{}: job {} failed: {}'.format(self._name, job.func, e))
+                error = e
+            last = time.monotonic()
+            job.done.set()
+
+            if job.callback is not None:
+                self._deliver(job.callback, result, error)
+            elif error is not None:
+                logger.error('{}: {}'.format(self._name, error))